@@ -0,0 +1,71 @@
+import logging
+
+# Setting Logger
+LOGGER = logging.getLogger(__name__)
+
+
+class IdAllocator():
+    """
+    Allocate integer id in [low, high] atomically with one document in db:
+    {
+      "name": "evpn_group_id",
+      "low": 1,
+      "high": 4096,
+      "next": 10,        # The smallest id never allocated
+      "free": [3, 7]     # Released id, all smaller than next
+    }
+    Allocate and release are single findAndModify/update requests, the payload is one id.
+    """
+    def __init__(self, db, name: str, low: int, high: int):
+        self.db = db
+        self.name = name
+        self.low = low
+        self.high = high
+
+    def setup(self, used_ids=None):
+        """
+        Create the allocator document if not exist
+        used_ids: ids allocated already, used when migrating from other storage
+        """
+        used_set = set(used_ids or [])
+        next_id = max(used_set) + 1 if used_set else self.low
+        free_list = [i for i in range(self.low, next_id) if i not in used_set]
+        init_data = {'name': self.name, 'low': self.low, 'high': self.high, 'next': next_id, 'free': free_list}
+        data = self.db.find_one_and_update({'name': self.name}, {'$setOnInsert': init_data}, upsert=True,
+                                           projection={'free': False})
+        LOGGER.warning(f"Setup id allocator ({self.name}), next: {data['next']}, high: {data['high']}")
+        return
+
+    def exists(self) -> bool:
+        return self.db.check_exist_one({'name': self.name})
+
+    def allocate(self):
+        """ Get a free id, return None when all ids are allocated """
+        # 1. Reuse released id first
+        filter_dict = {'name': self.name, 'free.0': {'$exists': True}}
+        data = self.db.find_one_and_update(filter_dict, {'$pop': {'free': -1}}, return_new=False,
+                                           projection={'free': {'$slice': 1}})
+        if data:
+            return data['free'][0]
+
+        # 2. Get a never allocated id
+        filter_dict = {'name': self.name, 'next': {'$lte': self.high}}
+        data = self.db.find_one_and_update(filter_dict, {'$inc': {'next': 1}}, return_new=False,
+                                           projection={'next': True})
+        if data:
+            return data['next']
+
+        LOGGER.debug(f"No available id in allocator ({self.name}), range: {self.low} - {self.high}")
+        return None
+
+    def release(self, old_id: int) -> bool:
+        """ Give back an id, return False when it is not allocated """
+        filter_dict = {'name': self.name, 'next': {'$gt': old_id}, 'free': {'$ne': old_id}}
+        if old_id < self.low or not self.db.update_one(filter_dict, {'$push': {'free': old_id}}):
+            LOGGER.error(f"Release id ({old_id}) failed, it is not allocated in allocator ({self.name})")
+            return False
+        return True
+
+    def snapshot(self):
+        """ Output: {"next": 10, "free": [3, 7]} """
+        return self.db.get_one_by_name(self.name, ['next', 'free'])
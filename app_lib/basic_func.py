@@ -4,13 +4,27 @@ from bson.objectid import ObjectId
 from dynaconf import settings
 from fastapi import HTTPException
 
-from app_lib.mongo_utility import DataLoader
+from app_lib.cache_utility import CachedDataLoader
+from app_lib.mongo_utility import DataLoader, decode_page_token, encode_page_token
 
 
 # Setting Logger
 LOGGER = logging.getLogger(__name__)
 
 
+def check_filter_not_modified(filter_dict, new_data):
+    """ Raise 400 when the values of filter_dict are modified in new_data, key not in new_data is not modified """
+    for key, val in filter_dict.items():
+        if key == '_id':
+            continue
+        elif new_data.get(key, val) != val:
+            LOGGER.error("Please don't modify filter in new data")
+            LOGGER.error(f"Filter key: {key}, Filter values: {val}")
+            LOGGER.error(f"New data value: {new_data[key]}")
+            raise HTTPException(status_code=400, detail=f"Post data value of key {key} is not same as input value in url.")
+    return
+
+
 def update_db_data(db, filter_dict, new_data, functionality: str):
     """ Update data in db with
     filter_dict:
@@ -21,19 +35,10 @@ def update_db_data(db, filter_dict, new_data, functionality: str):
     """
     if '_id' in filter_dict:
         filter_dict['_id'] = ObjectId(filter_dict['_id'])
-    if db.check_exist_one(filter_dict):
-        for key, val in filter_dict.items():
-            if key == '_id':
-                continue
-            elif new_data[key] != val:
-                LOGGER.error("Please don't modify filter in new data")
-                LOGGER.error(f"Filter key: {key}, Filter values: {val}")
-                LOGGER.error(f"New data value: {new_data[key]}")
-                raise HTTPException(status_code=400, detail=f"Post data value of key {key} is not same as input value in url.")
-        else:
-            # After for loop data, update db data by filter dict
-            update_data = {"$set": new_data}
-            db.update_one(filter_dict, update_data)
+    check_filter_not_modified(filter_dict, new_data)
+    # Update and check existence in one request
+    update_data = {"$set": new_data}
+    if db.update_one(filter_dict, update_data):
         return new_data
     else:
         detail_str = f"Device {functionality}, filter is not exist. Please use POST method. Filter: {filter_dict}"
@@ -51,16 +56,44 @@ def get_db_all_data(database: str, collection: str):
     return res_data
 
 
+def get_db_page_data(database: str, collection: str, sort_key: str, page_size: int = 100,
+                     page_token: str = None, reverse: bool = False, filter_dict: dict = None):
+    """
+    Get one page of db data sorted by sort_key
+    page_token: next_token of previous page, None for first page
+    Output:
+    {
+      "data": [...],
+      "next_token": "xxxx"   # None when it is last page
+    }
+    """
+    after = None
+    if page_token:
+        try:
+            token_sort_key, token_reverse, last_value, last_id = decode_page_token(page_token)
+        except ValueError:
+            LOGGER.error(f"Page token error, token: {page_token}")
+            raise HTTPException(status_code=400, detail='Page token error.')
+        if token_sort_key != sort_key or token_reverse != reverse:
+            LOGGER.error(f"Page token is not for this sorting, token: {token_sort_key}/{token_reverse}, input: {sort_key}/{reverse}")
+            raise HTTPException(status_code=400, detail='Page token is not for this sorting.')
+        after = (last_value, last_id)
+
+    db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'], database, collection)
+    res_data, next_after = db.get_page(sort_key, page_size, after, reverse, filter_dict)
+    next_token = None
+    if next_after is not None:
+        next_token = encode_page_token(sort_key, reverse, *next_after)
+    return {'data': res_data, 'next_token': next_token}
+
+
 def get_db_data_by_filter(database: str, collection: str, filter_dict: dict):
     """
     Get db data by filter
     """
     res_data = {}
-    db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'], database, collection)
-    if not db.check_exist_one(filter_dict):
-        return res_data
-
-    res_data = db.get_one_by_filter(filter_dict)
+    db = CachedDataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'], database, collection)
+    res_data = db.get_one_by_filter(filter_dict) or res_data
     return res_data
 
 
@@ -68,12 +101,13 @@ def write_data_to_mongo(database: str, collection: str, filter_dict: dict, new_d
     """ Update/Write data from mongo """
     db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'], database, collection)
     LOGGER.debug(f"Update {update_func}: {new_data}")
-    if db.check_exist_one(filter_dict):
-        LOGGER.warning(f"Data is found, update data. Filter: {filter_dict}")
-        _ = update_db_data(db, filter_dict, new_data, update_func)
-    else:
+    if '_id' in filter_dict:
+        filter_dict['_id'] = ObjectId(filter_dict['_id'])
+    check_filter_not_modified(filter_dict, new_data)
+    if db.upsert_one(filter_dict, new_data):
         LOGGER.warning(f"Data not found, add new one. Filter: {filter_dict}")
-        db.write_one(new_data)
+    else:
+        LOGGER.warning(f"Data is found, update data. Filter: {filter_dict}")
     return
 
 
@@ -0,0 +1,132 @@
+import copy
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+from dynaconf import settings
+
+from app_lib.mongo_utility import DataLoader, add_write_listener
+
+# Setting Logger
+LOGGER = logging.getLogger(__name__)
+
+# Read cache of each collection, key: (db_name, col_name)
+_COLLECTION_CACHES = {}
+
+
+class TTLCache():
+    """ Thread-safe LRU cache, entries expire after ttl seconds """
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # Increased by clear() and delete(), avoid caching data read before an invalidation
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Return (found, value) """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, item[1]
+
+    def set(self, key, value, ttl=None, generation=None):
+        """
+        ttl: override the default ttl of cache for this entry
+        generation: skip when cache was cleared after this generation
+        """
+        expire_time = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (expire_time, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.generation += 1
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+def enable_collection_cache(db_name: str, col_name: str, ttl: float = 30, maxsize: int = 10000):
+    """ Enable read cache of CachedDataLoader on collection """
+    LOGGER.warning(f"Enable read cache, {db_name}.{col_name}, ttl: {ttl}, maxsize: {maxsize}")
+    _COLLECTION_CACHES[(db_name, col_name)] = TTLCache(ttl, maxsize)
+
+
+def setup_read_cache():
+    """
+    Enable read cache from settings, default is disabled
+    MONGO_CACHE: [{"DB": "device", "COL": "management", "TTL": 30, "MAXSIZE": 10000}]
+    """
+    for cache_setting in settings.get('MONGO_CACHE', []):
+        enable_collection_cache(cache_setting['DB'], cache_setting['COL'],
+                                cache_setting.get('TTL', 30), cache_setting.get('MAXSIZE', 10000))
+
+
+def invalidate_collection_cache(db_name: str, col_name: str):
+    """ Drop all cached reads of collection, called after every write in this process """
+    cache = _COLLECTION_CACHES.get((db_name, col_name))
+    if cache is not None:
+        cache.clear()
+
+
+def get_cache_stats():
+    """
+    Get hit/miss counters of all collection caches
+    Output: {"device.management": {"size": 10, "maxsize": 10000, "ttl": 30, "hits": 100, "misses": 10}}
+    """
+    return {f"{db_name}.{col_name}": cache.stats() for (db_name, col_name), cache in _COLLECTION_CACHES.items()}
+
+
+add_write_listener(invalidate_collection_cache)
+
+
+class CachedDataLoader(DataLoader):
+    """
+    DataLoader with read-through cache on single document getters.
+    Cache is used only when enabled on the collection, and it is cleared by every write of this process.
+    Writes from other processes are visible after ttl.
+    """
+    def _cached_read(self, method, *args):
+        cache = _COLLECTION_CACHES.get((self.db_name, self.db_col))
+        if cache is None:
+            return getattr(super(), method)(*args)
+
+        key = (method, repr(args))
+        generation = cache.generation
+        found, data = cache.get(key)
+        if not found:
+            data = getattr(super(), method)(*args)
+            cache.set(key, data, generation=generation)
+        # Callers modify the return data, always return a copy
+        return copy.deepcopy(data)
+
+    def get_one_by_name(self, name, projection=None):
+        return self._cached_read('get_one_by_name', name, projection)
+
+    def get_one_by_key(self, key, value, projection=None):
+        return self._cached_read('get_one_by_key', key, value, projection)
+
+    def get_one_by_filter(self, filter_dict, projection=None):
+        return self._cached_read('get_one_by_filter', filter_dict, projection)
@@ -0,0 +1,194 @@
+import copy
+import logging
+import threading
+
+from dynaconf import settings
+from pymongo.errors import PyMongoError
+
+from app_lib.mongo_utility import DataLoader
+
+# Setting Logger
+LOGGER = logging.getLogger(__name__)
+
+# Seconds between retries after stream error
+STREAM_RETRY_INTERVAL = 5
+
+# Views enabled by settings CHANGE_STREAM: {"ENABLED": true}
+# key: settings['MONGO']['DEVICE'][key]['COL'], value: fields kept in view, None for whole document
+VIEW_SPEC = {
+    'FULLINFO': ['name', 'timestamp', 'health_shards', 'health_shard'],
+    'MANAGEMENT': None,
+    'STAGING': ['name'],
+}
+
+_VIEWS = {}
+
+
+class CollectionView():
+    """
+    In-process copy of one collection keyed by name, kept up to date by its change stream
+    1. Open change stream, only the fields in view are sent by server
+    2. Load snapshot, events older than the snapshot are skipped by cluster time
+    3. Apply insert/replace/update with the full document, delete by the _id -> name map
+    After a stream error the view is kept and the stream resumes from the last token, a new stream
+    and snapshot are loaded only when resuming fails. The view lives in memory, a restarted process
+    always loads a snapshot.
+    Change streams need a replica set, a local single-node one is enough:
+    mongod --replSet rs0, then rs.initiate() in mongo shell
+    """
+    def __init__(self, key: str, db: DataLoader, fields):
+        self.key = key
+        self.db = db
+        self.fields = fields
+        self.docs = {}
+        self.ready = False
+        self._names = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._resume_token = None
+        self._resuming = False
+
+    def _project(self, data: dict) -> dict:
+        if self.fields is None:
+            return {k: v for k, v in data.items() if k != '_id'}
+        return {k: data[k] for k in self.fields if k in data}
+
+    def _put(self, data: dict):
+        old_name = self._names.get(data['_id'])
+        if old_name is not None and old_name != data.get('name'):
+            self.docs.pop(old_name, None)
+        if 'name' in data:
+            self._names[data['_id']] = data['name']
+            self.docs[data['name']] = self._project(data)
+
+    def _remove(self, _id):
+        name = self._names.pop(_id, None)
+        if name is not None:
+            self.docs.pop(name, None)
+
+    def _load_snapshot(self):
+        # Readers go to db until snapshot is loaded
+        self.ready = False
+        with self._lock:
+            self.docs = {}
+            self._names = {}
+            projection = None if self.fields is None else list(set(self.fields) | {'name'})
+            for data in self.db.iter_all_elements_with_id(projection):
+                self._put(data)
+            self.ready = True
+        LOGGER.warning(f"Load {self.key} view, total: {len(self.docs)}")
+
+    def apply(self, change: dict):
+        with self._lock:
+            if change['operationType'] in ('insert', 'replace', 'update'):
+                # fullDocument of update is None when document is deleted before lookup, wait for delete event
+                if change.get('fullDocument') is not None:
+                    self._put(change['fullDocument'])
+            elif change['operationType'] == 'delete':
+                self._remove(change['documentKey']['_id'])
+            elif change['operationType'] in ('drop', 'rename', 'dropDatabase', 'invalidate'):
+                self.docs = {}
+                self._names = {}
+
+    def _pipeline(self):
+        """ Project change events to fields in view, _id of event is the resume token """
+        if self.fields is None:
+            return None
+        project = {'operationType': True, 'clusterTime': True, 'documentKey': True, 'fullDocument._id': True}
+        project.update({f"fullDocument.{field}": True for field in set(self.fields) | {'name'}})
+        return [{'$project': project}]
+
+    def _watch(self):
+        """ Consume one change stream until stop or error """
+        resume_token = self._resume_token if self._resuming else None
+        with self.db.watch(self._pipeline(), resume_after=resume_token) as stream:
+            if resume_token is None:
+                snapshot_time = self.db.get_cluster_time()
+                self._load_snapshot()
+            else:
+                # View is up to date until resume token
+                snapshot_time = None
+                LOGGER.warning(f"Resume change stream of {self.key}")
+            self._resuming = False
+            while not self._stop.is_set():
+                change = stream.try_next()
+                if change is not None and (snapshot_time is None or change['clusterTime'] > snapshot_time):
+                    self.apply(change)
+                self._resume_token = stream.resume_token
+                if change is not None and change['operationType'] == 'invalidate':
+                    self._resume_token = None
+                    return
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._watch()
+            except PyMongoError as exc:
+                LOGGER.error(f"Change stream of {self.key} error, detail: {exc!r}")
+                if self.ready and self._resume_token is not None and not self._resuming:
+                    # Keep view and resume once, readers see the view without changes until then
+                    self._resuming = True
+                else:
+                    # ex: token is not in oplog anymore, start a new stream with snapshot
+                    self.ready = False
+                    self._resuming = False
+                    self._resume_token = None
+                self._stop.wait(STREAM_RETRY_INTERVAL)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"change-stream-{self.key}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.ready = False
+
+    def records(self, projection=None) -> list:
+        """ Copy of documents in view, projection ex: ['name', 'organization'] """
+        # Documents in view are replaced but never modified, copy them without holding the lock
+        with self._lock:
+            data_list = list(self.docs.values())
+        if projection is None:
+            return copy.deepcopy(data_list)
+        return [{k: data[k] for k in projection if k in data} for data in data_list]
+
+    def contains(self, name: str) -> bool:
+        return name in self.docs
+
+
+def start_change_stream_views():
+    """ Start views in VIEW_SPEC when settings CHANGE_STREAM is set """
+    stream_setting = settings.get('CHANGE_STREAM', {})
+    if not stream_setting or _VIEWS:
+        return
+    LOGGER.warning(f"Start change stream views: {list(VIEW_SPEC)}")
+    for key, fields in VIEW_SPEC.items():
+        db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
+                        settings['MONGO']['DEVICE']['DB'], settings['MONGO']['DEVICE'][key]['COL'])
+        _VIEWS[key] = CollectionView(key, db, fields)
+        _VIEWS[key].start()
+
+
+def stop_change_stream_views():
+    for view in _VIEWS.values():
+        view.stop()
+    _VIEWS.clear()
+
+
+def get_view(key: str):
+    """ Get view of collection, None when subscriber is not running or snapshot is not loaded yet """
+    view = _VIEWS.get(key)
+    if view is None or not view.ready:
+        return None
+    return view
+
+
+def is_staging_pending(device_name: str):
+    """ True/False when staging view is ready, otherwise None and caller should query db """
+    view = get_view('STAGING')
+    return None if view is None else view.contains(device_name)
@@ -0,0 +1,81 @@
+import logging
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Setting Logger
+LOGGER = logging.getLogger(__name__)
+
+# Device is down when its last basic report is older than this in seconds
+DEVICE_HEALTH_TIMEOUT = 90
+
+# Value of up flag column
+DOWN = 0
+UP = 1
+UNKNOWN = 2     # Device not in monitor db yet
+
+
+def evaluate_health(timestamps: array, timestamp_now: float, timeout: float = DEVICE_HEALTH_TIMEOUT) -> bytearray:
+    """
+    Health of each timestamp, 1 when abs(timestamp - now) < timeout, otherwise 0
+    Use numpy when installed, otherwise a loop over the array without per-device dict access
+    """
+    if numpy is not None:
+        column = numpy.frombuffer(timestamps, dtype=numpy.float64)
+        return bytearray((numpy.abs(column - timestamp_now) < timeout).astype(numpy.uint8).tobytes())
+    low, high = timestamp_now - timeout, timestamp_now + timeout
+    return bytearray(low < t < high for t in timestamps)
+
+
+def diff_rows(old: bytearray, new: bytearray) -> list:
+    """ Rows which value is different, old and new have same length """
+    if numpy is not None:
+        changed = numpy.frombuffer(old, dtype=numpy.uint8) != numpy.frombuffer(new, dtype=numpy.uint8)
+        return numpy.flatnonzero(changed).tolist()
+    return [row for row, (o, n) in enumerate(zip(old, new)) if o != n]
+
+
+class FleetState():
+    """
+    Columnar health state of devices, one row per device:
+    names: ["device_a", ...]          index: {"device_a": 0, ...}
+    timestamps: array('d')            8 bytes per device, last basic report
+    up: bytearray                     1 byte per device, DOWN/UP/UNKNOWN in monitor db
+    """
+    def __init__(self):
+        self.names = []
+        self.index = {}
+        self.timestamps = array('d')
+        self.up = bytearray()
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_records(cls, records):
+        """ Build from projected cursor of fullinfo, ex: iter_all_elements(projection=['name', 'timestamp']) """
+        state = cls()
+        for data in records:
+            state.index[data['name']] = len(state.names)
+            state.names.append(data['name'])
+            state.timestamps.append(data['timestamp'])
+        state.up = bytearray([UNKNOWN]) * len(state.names)
+        return state
+
+    def load_up_flags(self, records):
+        """ Fill up column from projected cursor of monitor, ex: iter_all_elements(projection=['name', 'up']) """
+        for data in records:
+            row = self.index.get(data['name'])
+            if row is not None:
+                self.up[row] = UP if data['up'] else DOWN
+
+    def evaluate(self, timestamp_now: float, timeout: float = DEVICE_HEALTH_TIMEOUT) -> bytearray:
+        return evaluate_health(self.timestamps, timestamp_now, timeout)
+
+    def transitions(self, health: bytearray) -> list:
+        """ Rows which health is different from up column, include devices not in monitor db """
+        return diff_rows(self.up, health)
@@ -2,12 +2,18 @@ import copy
 import time
 import logging
 
+from array import array
 from deepdiff import DeepDiff
 from dynaconf import settings
 from fastapi import HTTPException
-
-from app_lib.func_utility import (update_db_data, get_isp_location, get_device_status_data_by_name,
-                                  get_device_mgmt_data_by_name)
+from pymongo import UpdateOne
+
+from app_lib.fleet_utility import evaluate_health
+from app_lib.func_utility import (update_db_data, get_device_status_data_by_name, get_device_mgmt_data_by_name,
+                                  KeyedRecords)
+from app_lib.health_utility import report_device_health
+from app_lib.isp_utility import get_isp_location, get_isp_locations
+from app_lib.job_func_utility import gen_health_shard_fields
 from app_lib.mongo_utility import DataLoader
 from app_lib.rest_utility import send_restful
 
@@ -45,27 +51,25 @@ def gen_device_wans_isp(wans_data: dict) -> dict:
     Input: wans_data in device full info
     Output: wans_data with modified isp_name, if not public will input empty string
     """
-    isp_db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
-                        settings['MONGO']['ISP_CACHE']['DB'], settings['MONGO']['ISP_CACHE']['COL'])
-    for d in wans_data:
-        if d['public_ip']:
-            # is not none
-            if isp_db.check_exist_one_by_name(d['public_ip']):
-                isp_data = isp_db.get_one_by_name(d['public_ip'])
-                d['isp_name'] = isp_data['isp']
+    return gen_device_wans_isp_batch([wans_data])[0]
+
+
+def gen_device_wans_isp_batch(wans_data_list: list) -> list:
+    """
+    Description: Batch version of gen_device_wans_isp, resolve all public ip of reports together
+    Input: list of wans_data
+    Output: list of wans_data with modified isp_name
+    """
+    public_ip_list = [d['public_ip'] for wans_data in wans_data_list for d in wans_data if d['public_ip']]
+    isp_dict = get_isp_locations(public_ip_list)
+    for wans_data in wans_data_list:
+        for d in wans_data:
+            if d['public_ip']:
+                # is not none
+                d['isp_name'] = isp_dict[d['public_ip']][1]
             else:
-                _, isp_name, _, _ = get_isp_location(d['public_ip'])
-                # Insert data
-                isp_data = {
-                    "name": d['public_ip'],
-                    "isp": isp_name
-                }
-                isp_db.write_one(isp_data)
-                LOGGER.info(f"Write isp_data into isp_db: {isp_data}")
-                d['isp_name'] = isp_data['isp']
-        else:
-            d['isp_name'] = ""
-    return wans_data
+                d['isp_name'] = ""
+    return wans_data_list
 
 
 def check_device_status(device_name: str, device_content: dict):
@@ -80,7 +84,7 @@ def check_device_status(device_name: str, device_content: dict):
     db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
                     settings['MONGO']['DEVICE']['DB'], settings['MONGO']['DEVICE']['MANAGEMENT']['COL'])
 
-    device_mgmt_data = get_device_status_data_by_name(device_name)
+    device_mgmt_data = get_device_status_data_by_name(device_name, ['organization', 'status'])
     if device_mgmt_data:
         return device_mgmt_data['organization'], device_mgmt_data['status']
     else:
@@ -101,13 +105,10 @@ def check_device_up_status(device_info_list):
     Description: Check device full info static data
     1. Check timestamp and set device['up']
     """
-    for device in device_info_list:
-        # 1. Check timestamp and set
-        accual_time_now = time.time()
-        if -90 < (accual_time_now - device['timestamp']) < 90:
-            device['up'] = True
-        else:
-            device['up'] = False
+    # 1. Check timestamp of all devices at once and set
+    health = evaluate_health(array('d', [device['timestamp'] for device in device_info_list]), time.time())
+    for device, up in zip(device_info_list, health):
+        device['up'] = bool(up)
 
     return device_info_list
 
@@ -184,7 +185,7 @@ def handle_device_status_update(device_name: str, update_col: str, old_status_da
             # auto
             db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
                             settings['MONGO']['DEVICE']['DB'], settings['MONGO']['DEVICE']['FULLINFO']['COL'])
-            fullinfo_data = db.get_one_by_name(device_name)
+            fullinfo_data = db.get_one_by_name(device_name, ['wans'])
             old_status_data[update_col] = auto_gen_device_location(fullinfo_data['wans'])
     elif update_col == 'status':
         LOGGER.warning("Device status should not update this column by your own. Skip this change!!!!!")
@@ -195,6 +196,16 @@ def handle_device_status_update(device_name: str, update_col: str, old_status_da
     return old_status_data
 
 
+def migrate_device_data(src_db, dst_db, name_list):
+    """ Move device data from src_db to dst_db with one read, one insert and one delete """
+    device_data_list = src_db.get_many_by_filter({'name': {'$in': name_list}})
+    if dst_db.write_many(device_data_list) != len(name_list):
+        LOGGER.error(f"Migrate device data failed, {src_db.db_col} -> {dst_db.db_col}, name: {name_list}")
+        raise HTTPException(status_code=500, detail='Migrate device data failed.')
+    src_db.delete_many_by_name(name_list)
+    return
+
+
 def handle_device_stock_assign_org(content):
     """
     Description: Handle device stock assign organization data and migrate db data from manufacturer to fullinfo
@@ -210,7 +221,7 @@ def handle_device_stock_assign_org(content):
 
     # 1. Check the input content is all valid, otherwise return 500
     for device in content.device_pool:
-        device_status_data = get_device_status_data_by_name(device.name)
+        device_status_data = get_device_status_data_by_name(device.name, ['organization', 'status'])
         if not device_status_data:
             LOGGER.warning(f"Input device list: {content.device_pool}")
             LOGGER.error(f"Input device name ({device.name}) not found in status db strange")
@@ -234,18 +245,14 @@ def handle_device_stock_assign_org(content):
             raise HTTPException(status_code=400, detail=f"Device ({device.name}) should not found in fullinfo db.")
 
     # 2. Migrate device content from manufacturer_db to fullinfo_db, and update info to status_db
-    for device in content.device_pool:
-        LOGGER.warning(f"Migrate basic report data from manufacture_db to fullinfo_db, name: {device.name}")
-        manufacturer_device_data = manufacturer_db.get_one_by_name(device.name)
-        device_status_data = get_device_status_data_by_name(device.name)
-        fullinfo_db.write_one(manufacturer_device_data)
-        manufacturer_db.delete_one_by_name(device.name)
-        # Update status db
-        device_status_data['status'] = 0
-        device_status_data['organization'] = content.organization
-        filter_dict = {'name': device.name}
-        _ = update_db_data(status_db, filter_dict, device_status_data, "device status info")
-        LOGGER.warning(f"Migrate basic report data success, name: {device.name}")
+    name_list = [device.name for device in content.device_pool]
+    LOGGER.warning(f"Migrate basic report data from manufacture_db to fullinfo_db, name: {name_list}")
+    migrate_device_data(manufacturer_db, fullinfo_db, name_list)
+    # Update status db
+    update_list = [UpdateOne({'name': name}, {'$set': {'status': 0, 'organization': content.organization}})
+                   for name in name_list]
+    _ = status_db.bulk_write(update_list)
+    LOGGER.warning(f"Migrate basic report data success, name: {name_list}")
 
     return content
 
@@ -265,7 +272,7 @@ def handle_device_parkinglot_reset(content):
 
     # 1. Check the input content is all valid, otherwise return 500
     for device in content.device_pool:
-        device_status_data = get_device_status_data_by_name(device.name)
+        device_status_data = get_device_status_data_by_name(device.name, ['organization', 'status'])
         if not device_status_data:
             LOGGER.warning(f"Input device list: {content.device_pool}")
             LOGGER.error(f"Input device name ({device.name}) not found in status db strange")
@@ -289,17 +296,12 @@ def handle_device_parkinglot_reset(content):
             raise HTTPException(status_code=400, detail=f"Device ({device.name}) not found in fullinfo db.")
 
     # 2. Migrate device content from fullinfo_db to manufacturer_db, and update info to status_db
-    for device in content.device_pool:
-        LOGGER.warning(f"Migrate basic report data from fullinfo_db to manufacture_db, name: {device.name}")
-        fullinfo_device_data = fullinfo_db.get_one_by_name(device.name)
-        device_status_data = get_device_status_data_by_name(device.name)
-        manufacturer_db.write_one(fullinfo_device_data)
-        fullinfo_db.delete_one_by_name(device.name)
-        # Update status db
-        device_status_data['status'] = -1
-        device_status_data['organization'] = None
-        filter_dict = {'name': device.name}
-        _ = update_db_data(status_db, filter_dict, device_status_data, "device status info")
+    name_list = [device.name for device in content.device_pool]
+    LOGGER.warning(f"Migrate basic report data from fullinfo_db to manufacture_db, name: {name_list}")
+    migrate_device_data(fullinfo_db, manufacturer_db, name_list)
+    # Update status db
+    update_list = [UpdateOne({'name': name}, {'$set': {'status': -1, 'organization': None}}) for name in name_list]
+    _ = status_db.bulk_write(update_list)
 
     return content
 
@@ -314,6 +316,8 @@ def set_device_info_4_manufacturer_db(content):
     device_fullinfo = content.dict(by_alias=True)
     # Check wans.isp_name
     device_fullinfo['wans'] = gen_device_wans_isp(device_fullinfo['wans'])
+    # Shard of partitioned health checking
+    device_fullinfo.update(gen_health_shard_fields(device_fullinfo['name']))
 
     if db.check_exist_one_by_name(device_fullinfo['name']):
         LOGGER.warning(f"Update device {device_fullinfo['name']} basic report in manufacturer db!")
@@ -416,13 +420,12 @@ def generate_diff_data_detail(old_data, new_data):
                             res_sub_data_list = generate_action_data_and_append(res_sub_data_list, 'DELETE', data)
                 if list_to_be_put:
                     # data to be put, error
+                    new_records = KeyedRecords(new_data[key], primary_key)
                     for data_old in old_data[key]:
-                        for data_new in new_data[key]:
-                            if data_old[primary_key] == data_new[primary_key]:
-                                if compare_two_device_template_dict(data_old, data_new):
-                                    # different data
-                                    res_sub_data_list = generate_action_data_and_append(res_sub_data_list, 'PUT', data_new)
-                                    break
+                        data_new = new_records.get(data_old[primary_key])
+                        if data_new is not None and compare_two_device_template_dict(data_old, data_new):
+                            # different data
+                            res_sub_data_list = generate_action_data_and_append(res_sub_data_list, 'PUT', data_new)
         else:
             LOGGER.error(f"Type error, yout data type: {type(new_data[key])}")
             LOGGER.error(f"Values in old_data: {old_data[key]}")
@@ -532,11 +535,13 @@ def set_device_info_4_fullinfo_db(content, skip_compare):
     device_fullinfo = content.dict(by_alias=True)
     # Check wans.isp_name
     device_fullinfo['wans'] = gen_device_wans_isp(device_fullinfo['wans'])
+    # Shard of partitioned health checking
+    device_fullinfo.update(gen_health_shard_fields(device_fullinfo['name']))
 
     if db.check_exist_one_by_name(device_fullinfo['name']):
         if not skip_compare:
             # status = deployed(1), check diff
-            old_device_info = db.get_one_by_name(device_fullinfo['name'])
+            old_device_info = db.get_one_by_name(device_fullinfo['name'], ['device_config'])
             device_fullinfo['device_config'] = compare_device_config(device_fullinfo['name'],
                                                                      old_device_info['device_config'],
                                                                      device_fullinfo['device_config'],
@@ -560,6 +565,7 @@ def set_device_info_4_fullinfo_db(content, skip_compare):
         LOGGER.debug(device_fullinfo)
         db.write_one(device_fullinfo)
 
+    report_device_health(device_fullinfo['name'], device_fullinfo['timestamp'])
     return
 
 
@@ -637,7 +643,7 @@ def get_stage_data_in_db(device_name: str):
         original_stage_new_data = diff_data['new_gui_data']
     elif fullinfo_db.check_exist_one_by_name(device_name):
         # get the old staging data from fullinfo_db['device_config']
-        device_data = fullinfo_db.get_one_by_name(device_name)
+        device_data = fullinfo_db.get_one_by_name(device_name, ['device_config'])
         original_stage_old_data = copy.deepcopy(device_data['device_config'])
         original_stage_new_data = copy.deepcopy(device_data['device_config'])
     else:
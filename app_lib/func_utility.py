@@ -1,5 +1,4 @@
 import time
-import uuid
 import logging
 
 import firebase_admin
@@ -9,19 +8,43 @@ from fastapi import HTTPException
 from firebase_admin import credentials
 from typing import List
 
-from app_lib.basic_func import write_data_to_mongo, get_db_data_by_filter
-from app_lib.mongo_utility import DataLoader
+from app_lib.allocator_utility import IdAllocator
+from app_lib.basic_func import write_data_to_mongo, get_db_data_by_filter, update_db_data  # noqa: F401
+from app_lib.cache_utility import CachedDataLoader, TTLCache, setup_read_cache
+from app_lib.change_stream_utility import get_view, start_change_stream_views
+from app_lib.health_utility import start_health_scheduler
+from app_lib.igate_utility import get_cached_igate_status, set_cached_igate_status, start_igate_status_refresher
+from app_lib.index_utility import setup_db_indexes, report_collection_scans
+from app_lib.isp_utility import get_isp_location  # noqa: F401
+from app_lib.metrics_utility import enable_mongo_metrics
+from app_lib.mongo_utility import DataLoader, add_write_listener, configure_client_pool
+from app_lib.notification_utility import send_mgmt_notification, send_device_notification, start_notification_dispatcher  # noqa: F401
 from app_lib.rest_utility import send_restful
 from core.devicemgr_config import (FIRE_CRED_PATH, MAX_EVPN_GROUP_ID)
 
 # Setting Logger
 LOGGER = logging.getLogger(__name__)
 
+# Organization -> host list index, enabled by settings ORG_HOST_INDEX: {"TTL": 60, "MAXSIZE": 1000}
+_ORG_HOST_INDEX = None
+
 
 def setup_system_initialize():
     """ Setup device manager initialized status """
+    # Pool options and metrics listener must be set before the first DataLoader is created
+    configure_client_pool(**settings.get('MONGO_CLIENT_OPTIONS', {}))
+    if settings.get('MONGO_METRICS', False):
+        enable_mongo_metrics(settings.get('MONGO_METRICS_MEASURE_BYTES', False))
+    setup_read_cache()
+    setup_org_host_index()
+    setup_db_indexes()
+    report_collection_scans()
     setup_device_version(settings['AGENT_VERSION'])
     setup_evpn_group_list()
+    start_igate_status_refresher()
+    start_notification_dispatcher()
+    start_change_stream_views()
+    start_health_scheduler()
     firebase_admin.initialize_app(credentials.Certificate(FIRE_CRED_PATH))
 
 
@@ -50,49 +73,45 @@ def generate_sequence_number(low, high):
     return list(range(low, high+1))
 
 
-def get_evpn_group_id():
-    """ Get a new evpn group id from db avaiable list """
+def get_evpn_group_id_allocator():
+    """ Get evpn group id allocator in db """
     db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
                     settings['MONGO']['TUNNEL']['EVPN']['DB'], settings['MONGO']['TUNNEL']['EVPN']['GROUP']['COL'])
+    return IdAllocator(db, 'evpn_group_id', 1, MAX_EVPN_GROUP_ID)
 
-    search_key = 'available_id_list'
-    data = db.get_one_by_name(search_key)
-    new_id = data['list'].pop(0)
-    LOGGER.warning(f'Apply new evpn group id: {new_id}')
 
-    filter_dict = {'name': search_key}
-    _ = update_db_data(db, filter_dict, data, "evpn group id list")
+def get_evpn_group_id():
+    """ Get a new evpn group id from db avaiable list """
+    new_id = get_evpn_group_id_allocator().allocate()
+    if new_id is None:
+        LOGGER.error(f"No available evpn group id, max id: {MAX_EVPN_GROUP_ID}")
+        raise HTTPException(status_code=400, detail='No available evpn group id.')
+    LOGGER.warning(f'Apply new evpn group id: {new_id}')
     return new_id
 
 
 def delete_evpn_group_id(old_id):
     """ Recycle a evpn group id to db when evpn group delete """
-    db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
-                    settings['MONGO']['TUNNEL']['EVPN']['DB'], settings['MONGO']['TUNNEL']['EVPN']['GROUP']['COL'])
-
-    search_key = 'available_id_list'
-    data = db.get_one_by_name(search_key)
-    data['list'].append(old_id)
-
-    filter_dict = {'name': search_key}
-    _ = update_db_data(db, filter_dict, data, "evpn group id list")
+    _ = get_evpn_group_id_allocator().release(old_id)
     return
 
 
 def setup_evpn_group_list():
-    """ Setup evpn tunnel group id list """
-    db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
-                    settings['MONGO']['TUNNEL']['EVPN']['DB'], settings['MONGO']['TUNNEL']['EVPN']['GROUP']['COL'])
-
-    if len(db.get_all_elements()) == 0:
-        LOGGER.warning('Tunnel evpn list in db initialization...')
-        data = {}
-        data['name'] = 'available_id_list'
-        data['list'] = generate_sequence_number(1, MAX_EVPN_GROUP_ID)
-        db.write_one(data)
+    """ Setup evpn tunnel group id allocator, migrate from the old available_id_list if existed """
+    allocator = get_evpn_group_id_allocator()
+    if allocator.exists():
+        LOGGER.warning('Tunnel evpn group id allocator has set in db!')
+        return
+
+    LOGGER.warning('Tunnel evpn group id allocator in db initialization...')
+    legacy_data = allocator.db.get_one_by_name('available_id_list')
+    if legacy_data:
+        available_set = set(legacy_data['list'])
+        used_ids = [i for i in generate_sequence_number(1, MAX_EVPN_GROUP_ID) if i not in available_set]
+        allocator.setup(used_ids)
+        allocator.db.delete_one_by_name('available_id_list')
     else:
-        LOGGER.warning('Tunnel evpn list has set in db!')
-        pass
+        allocator.setup()
     return
 
 
@@ -111,26 +130,14 @@ def set_time_and_location(content):
     return content
 
 
-def get_isp_location(public_ip):
-    """ Get server location with isp url """
-    LOGGER.debug(f"Retrieve location of pubic ip: {public_ip}")
-    isp_url = settings['DETECT_ISP_URL'] + public_ip
-    res_data, res_code = send_restful(isp_url)
-    if res_code == 200 and res_data['status'] == 'success':
-        return True, res_data.get('isp'), res_data.get('lat'), res_data.get('lon')
-    else:
-        LOGGER.error(f"Call {isp_url} to get location failed")
-        LOGGER.error(f"Res code: {res_code}, res status: {res_data['status']}")
-        return False, "", 0, 0
-
-
-def get_device_status_data_by_name(device_name: str):
+def get_device_status_data_by_name(device_name: str, projection=None):
     """
     Description: Get device status data by name in device status db
     DB: device
     COL: management
     Input:
     device_name: SDWAN-xx-xx-xx-xx-xx-xx
+    projection: return fields, ex: ['organization', 'status'], None for all fields
     Output:
     {
       "name": "SDWAN-xx-xx-xx-xx-xx-xx", # str
@@ -144,41 +151,68 @@ def get_device_status_data_by_name(device_name: str):
       }
     }
     """
-    db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
+    db = CachedDataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
                     settings['MONGO']['DEVICE']['DB'], settings['MONGO']['DEVICE']['MANAGEMENT']['COL'])
-    if db.check_exist_one_by_name(device_name):
-        device_mgmt_data = db.get_one_by_name(device_name)
-        return device_mgmt_data
-    else:
+    device_mgmt_data = db.get_one_by_name(device_name, projection)
+    if device_mgmt_data is None:
         LOGGER.warning(f"Input device name ({device_name}) not found in status db.")
-        return None
+    return device_mgmt_data
 
 
-def get_device_status_data():
+def get_device_status_data(projection=None):
     """
     Description: Get device status all data in device status db
     DB: device
     COL: management
+    projection: return fields, ex: ['name', 'organization'], None for all fields
+    Read from change stream view when it is running
     """
+    view = get_view('MANAGEMENT')
+    if view is not None and not isinstance(projection, dict):
+        return view.records(projection)
+
     db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
                     settings['MONGO']['DEVICE']['DB'], settings['MONGO']['DEVICE']['MANAGEMENT']['COL'])
 
     device_mgmt_data = []
-    device_mgmt_data = db.get_all_elements()
+    device_mgmt_data = db.get_all_elements(projection)
 
     return device_mgmt_data
 
 
+def setup_org_host_index():
+    """ Enable in-process organization -> host list index, ttl bounds the changes from other processes """
+    global _ORG_HOST_INDEX
+    index_setting = settings.get('ORG_HOST_INDEX', {})
+    if index_setting:
+        LOGGER.warning(f"Enable organization host index, setting: {index_setting}")
+        _ORG_HOST_INDEX = TTLCache(index_setting.get('TTL', 60), index_setting.get('MAXSIZE', 1000))
+        add_write_listener(invalidate_org_host_index_on_write)
+
+
+def invalidate_org_host_index_on_write(db_name: str, col_name: str):
+    """ Drop whole index after every write of management collection, the organization is written by the caller """
+    if _ORG_HOST_INDEX is None:
+        return
+    if (db_name, col_name) == (settings['MONGO']['DEVICE']['DB'], settings['MONGO']['DEVICE']['MANAGEMENT']['COL']):
+        _ORG_HOST_INDEX.clear()
+
+
 def get_host_list_by_org(organization: str) -> List:
     """ Get the hostname list filter by orgnization name """
-    # Get status list in status_db
-    status_data = get_device_status_data()
+    if _ORG_HOST_INDEX is not None:
+        generation = _ORG_HOST_INDEX.generation
+        found, res_data = _ORG_HOST_INDEX.get(organization)
+        if found:
+            return list(res_data)
 
-    res_data = []
-    for d in status_data:
-        if d.get('organization') == organization:
-            res_data.append(d.get('name'))
+    # Filter by organization in status_db, only get name
+    db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
+                    settings['MONGO']['DEVICE']['DB'], settings['MONGO']['DEVICE']['MANAGEMENT']['COL'])
+    res_data = [d['name'] for d in db.iter_many_by_filter({'organization': organization}, ['name'])]
 
+    if _ORG_HOST_INDEX is not None:
+        _ORG_HOST_INDEX.set(organization, tuple(res_data), generation=generation)
     return res_data
 
 
@@ -196,14 +230,12 @@ def get_device_mgmt_data_by_name(device_name: str) -> str:
       "uuid": "f6547b25cdae4a859eb7af2d7cdfaae8"
     }
     """
-    db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
+    db = CachedDataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
                     settings['MONGO']['MANAGEMENT']['DB'], settings['MONGO']['MANAGEMENT']['COL'])
 
-    if db.check_exist_one_by_name(device_name):
-        device_mgmt_data = db.get_one_by_name(device_name)
-    else:
+    device_mgmt_data = db.get_one_by_name(device_name)
+    if device_mgmt_data is None:
         LOGGER.warning(f"Input device name ({device_name}) not found in management db.")
-        return None
 
     return device_mgmt_data
 
@@ -223,36 +255,6 @@ def check_data_org(db, device_name: str, org_name: str, functionality: str, self
     return
 
 
-def update_db_data(db, filter_dict, new_data, functionality: str):
-    """ Update data in db with
-    filter_dict:
-    {
-      "key1": value1,
-      "key2": value2
-    }
-    """
-    if '_id' in filter_dict:
-        filter_dict['_id'] = ObjectId(filter_dict['_id'])
-    if db.check_exist_one(filter_dict):
-        for key, val in filter_dict.items():
-            if key == '_id':
-                continue
-            elif new_data[key] != val:
-                LOGGER.error("Please don't modify filter in new data")
-                LOGGER.error(f"Filter key: {key}, Filter values: {val}")
-                LOGGER.error(f"New data value: {new_data[key]}")
-                raise HTTPException(status_code=400, detail=f"Post data value of key {key} is not same as input value in url.")
-        else:
-            # After for loop data, update db data by filter dict
-            update_data = {"$set": new_data}
-            db.update_one(filter_dict, update_data)
-        return new_data
-    else:
-        detail_str = f"Device {functionality}, filter is not exist. Please use POST method. Filter: {filter_dict}"
-        LOGGER.error(detail_str)
-        raise HTTPException(status_code=400, detail=detail_str)
-
-
 def check_igate_online(gw_ip: str, gw_port: str):
     """ Check iGate is online or not and update db """
     req_url = f"http://{gw_ip}:{gw_port}/hermesvpn/client"
@@ -265,8 +267,11 @@ def check_igate_online(gw_ip: str, gw_port: str):
         return False, []
 
 
-def get_gw_data_and_check(gw_name: str, check_offline: bool):
-    """ Get tgserver info from db and check online status """
+def get_gw_data_and_check(gw_name: str, check_offline: bool, force_refresh: bool = False):
+    """
+    Get tgserver info from db and check online status
+    force_refresh: probe iGate even if the cached liveness is fresh
+    """
 
     filter_dict = {'name': gw_name}
     gw_data = get_db_data_by_filter(settings['MONGO']['GWPOOL']['DB'], settings['MONGO']['GWPOOL']['COL'], filter_dict)
@@ -281,13 +286,19 @@ def get_gw_data_and_check(gw_name: str, check_offline: bool):
 
     is_online = False
     data = []
-    if check_offline:
+    cached_status = None if force_refresh else get_cached_igate_status(gw_name)
+    if cached_status:
+        # Liveness is refreshed in background, no network call on request path
+        is_online, data = cached_status['status'], cached_status['device_list']
+    elif check_offline:
         # Check all iGate whether it online or not
         is_online, data = check_igate_online(gw_data['ip'], gw_data['port'])
+        set_cached_igate_status(gw_name, is_online, data)
     else:
         # Only check online iGate
         if gw_data['status']:
             is_online, data = check_igate_online(gw_data['ip'], gw_data['port'])
+            set_cached_igate_status(gw_name, is_online, data)
 
     # Renew db data when status changed
     if is_online != gw_data['status']:
@@ -300,9 +311,9 @@ def get_gw_data_and_check(gw_name: str, check_offline: bool):
     return gw_data
 
 
-def get_gw_data(gw_name: str):
+def get_gw_data(gw_name: str, force_refresh: bool = False):
     """ Get gw data """
-    gw_data = get_gw_data_and_check(gw_name, True)
+    gw_data = get_gw_data_and_check(gw_name, True, force_refresh)
 
     if not gw_data['status']:
         # Raise exception when iGate is down
@@ -313,6 +324,68 @@ def get_gw_data(gw_name: str):
     return gw_data
 
 
+class KeyedRecords():
+    """
+    List of dict indexed by primary key, lookup/merge/delete in O(n+m)
+    Input:
+    records = [{"name": "A", "value": 1}, {"name": "B", "value": 2}]
+    key = "name" (or "lan_name" of dhcp)
+
+    PS:
+    When key is duplicated, only the first record is indexed
+    """
+    def __init__(self, records: List, key: str = 'name'):
+        self.key = key
+        self.records = records
+        self.index = {}
+        self.duplicated_keys = set()
+        for d in records:
+            self._add_index(d)
+
+    def _add_index(self, record: dict):
+        if record[self.key] in self.index:
+            self.duplicated_keys.add(record[self.key])
+        else:
+            self.index[record[self.key]] = record
+
+    def __contains__(self, key_value):
+        return key_value in self.index
+
+    def get(self, key_value, default=None):
+        return self.index.get(key_value, default)
+
+    def get_values(self, key_list: List, value_key: str) -> List:
+        """ Get record[value_key] of each key in key_list, skip key not found, record without value_key or None value """
+        res_data = []
+        for key_value in key_list:
+            d = self.index.get(key_value)
+            if d is None:
+                continue
+            if key_value in self.duplicated_keys:
+                LOGGER.warning("It seems stange that there have two same keys in db!!!!")
+                LOGGER.warning(f"Please check the key of {self.key}: {key_value}")
+            if value_key in d:
+                if d[value_key] is not None:
+                    res_data.append(d[value_key])
+            else:
+                LOGGER.warning("It seems stange that no value in db!!!!")
+                LOGGER.warning(f"Please check the key of {self.key}: {key_value}, key of your value: {value_key}")
+        return res_data
+
+    def merge(self, append_list: List) -> List:
+        """ Append records which key is not in records, return records (modified in place) """
+        filtered_list = [d for d in append_list if d[self.key] not in self.index]
+        self.records.extend(filtered_list)
+        for d in filtered_list:
+            self._add_index(d)
+        return self.records
+
+    def delete(self, delete_list: List) -> List:
+        """ Return new list without the records which key is in delete_list """
+        delete_set = {d[self.key] for d in delete_list}
+        return [d for d in self.records if d[self.key] not in delete_set]
+
+
 def search_and_append_dict_to_list_of_dict(origin_list: List, append_list: List) -> List:
     """
     Input:
@@ -325,16 +398,8 @@ def search_and_append_dict_to_list_of_dict(origin_list: List, append_list: List)
     PS:
     The order of list is not important
     """
-    # Get list of key in origin_list
-    filter_list = [d['name'] for d in origin_list]
-    LOGGER.debug(f"Key to be add: {filter_list}")
-    # Check filter_list in append_list and get list need to be append to origin_list
-    filtered_list = [d for d in append_list if d['name'] not in filter_list]
-
-    # Append list of dict to origin_list
-    origin_list.extend(filtered_list)
-
-    return origin_list
+    # Append list of dict to origin_list which name is not in origin_list
+    return KeyedRecords(origin_list).merge(append_list)
 
 
 def search_and_delete_dict_from_list_of_dict(origin_list: List, delete_list: List) -> List:
@@ -349,13 +414,8 @@ def search_and_delete_dict_from_list_of_dict(origin_list: List, delete_list: Lis
     PS:
     The order of list is not important
     """
-    # Get list of key in delete_list
-    filter_list = [d['name'] for d in delete_list]
-    LOGGER.debug(f"Key to be delete: {filter_list}")
-    # Remain the dict which name is not in filter_list
-    filtered_list = [d for d in origin_list if d['name'] not in filter_list]
-
-    return filtered_list
+    # Remain the dict which name is not in delete_list
+    return KeyedRecords(origin_list).delete(delete_list)
 
 
 def search_key_from_list_of_dict(origin_list: List, name_key: str, value_key: str):
@@ -368,22 +428,9 @@ def search_key_from_list_of_dict(origin_list: List, name_key: str, value_key: st
     Output:
     return_value = 2
     """
-    # Check filter_list in append_list and get list need to be append to origin_list
-    filtered_list = [d for d in origin_list if d['name'] == name_key]
-    if len(filtered_list) > 1:
-        LOGGER.warning("It seems stange that there have two same keys in db!!!!")
-        LOGGER.warning(f"Please check origin list: {origin_list}")
-        LOGGER.warning(f"Please check the key of name: {name_key}")
-
     # We only check the first one!!!!!
-    for d in filtered_list:
-        if value_key in d:
-            return d[value_key]
-        else:
-            LOGGER.warning("It seems stange that no value in db!!!!")
-            LOGGER.warning(f"Please check origin list: {origin_list}, key: {name_key}")
-            LOGGER.warning(f"Please check the key of your value: {value_key}")
-            return None
+    res_data = KeyedRecords(origin_list).get_values([name_key], value_key)
+    return res_data[0] if res_data else None
 
 
 def search_value_with_key_from_list_of_dict(origin_list: List, name_list: List, value_key: str):
@@ -396,51 +443,5 @@ def search_value_with_key_from_list_of_dict(origin_list: List, name_list: List,
     Output:
     return_value = [1, 2]
     """
-    res_data = []
-    for element in name_list:
-        search_value = search_key_from_list_of_dict(origin_list, element['name'], value_key)
-        if search_value is None:
-            pass
-        else:
-            res_data.append(search_value)
-
-    return res_data
-
-
-def send_mgmt_notification(level: str, subject: str, api_url: str, detail_msg: str, body: dict = {}):
-    """ When System error, send notification api to notifactionmgr """
-    req_url = f"http://{settings['NOTIFICATIONMGR_SERVER']['IP']}:{settings['NOTIFICATIONMGR_SERVER']['PORT']}/hermesnotification/mgmt"
-    send_data = {}
-    send_data['name'] = 'devicemgr'
-    send_data['level'] = level
-    send_data['subject'] = subject
-    send_data['req_url'] = str(api_url)
-    send_data['detail_msg'] = detail_msg
-    if body:
-        send_data['body'] = body
-    _, res_code = send_restful(req_url, req_type='post', payload=send_data, time_out=8)
-    if res_code != 201:
-        LOGGER.error(f"Send api to notification error, req_url: {req_url}")
-    return
-
-
-def send_device_notification(device_name: str, subject: str, level: str, detail_msg: str, timestamp: int):
-    """
-    When device event, send notification api to notificationmgr
-    level: Info/Warning/Critical
-    """
-    req_url = f"http://{settings['NOTIFICATIONMGR_SERVER']['IP']}:{settings['NOTIFICATIONMGR_SERVER']['PORT']}/hermesnotification/agent"
-    send_data = {}
-    sub_data = {}
-    send_data['name'] = device_name
-    sub_data['uuid'] = str(uuid.uuid1())
-    sub_data['subject'] = subject
-    sub_data['read'] = False
-    sub_data['level'] = level
-    sub_data['message'] = detail_msg
-    sub_data['timestamp'] = timestamp
-    send_data['notification'] = sub_data
-    _, res_code = send_restful(req_url, req_type='post', payload=send_data, time_out=8)
-    if res_code != 201:
-        LOGGER.error(f"Send api to notification error, req_url: {req_url}")
-    return
+    # Index origin_list once instead of scanning it for every name
+    return KeyedRecords(origin_list).get_values([element['name'] for element in name_list], value_key)
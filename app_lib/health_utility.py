@@ -0,0 +1,187 @@
+import time
+import heapq
+import logging
+import threading
+
+from dynaconf import settings
+
+from app_lib.job_func_utility import (DEVICE_HEALTH_TIMEOUT, get_device_db, is_device_healthy, load_monitor_state,
+                                      commit_device_transition)
+
+# Setting Logger
+LOGGER = logging.getLogger(__name__)
+
+# Seconds between full reconciliation, override by settings HEALTH_SCHEDULER: {"RECONCILE_INTERVAL": 300}
+HEALTH_RECONCILE_INTERVAL = 300
+
+SCHEDULER = None
+
+
+class HealthScheduler():
+    """
+    Deadline driven device health checking, near real time alternative to the periodic checking_device_procedure
+    - Basic report: device is up until timestamp + DEVICE_HEALTH_TIMEOUT, up event fires when it was down.
+      report() only updates memory, db writes and notifications run in scheduler thread.
+    - Deadline: heap of (deadline, name), down event fires when the latest deadline of a device passes.
+      A report only pushes a new entry, outdated entries are skipped when popped.
+    - Reconcile: rebuild deadlines from fullinfo and monitor db, catch reports handled by other processes
+    Expired devices are checked against fullinfo before down event, and every transition is a conditional
+    update on monitor db, notified only when it matched, so running one scheduler per api worker, or together
+    with the periodic sweep, will not send false or duplicate events.
+    """
+    def __init__(self, reconcile_interval: float = HEALTH_RECONCILE_INTERVAL):
+        self.reconcile_interval = reconcile_interval
+        self._heap = []
+        self._deadline = {}
+        self._up = {}
+        # Devices which came up by report, committed by scheduler thread
+        self._pending_up = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def _set_deadline(self, device_name: str, deadline: float):
+        """ Keep the latest deadline, report with older timestamp is ignored """
+        if deadline <= self._deadline.get(device_name, 0):
+            return
+        self._deadline[device_name] = deadline
+        heapq.heappush(self._heap, (deadline, device_name))
+        self._cond.notify()
+
+    def _is_healthy(self, device_name: str, timestamp_now: float) -> bool:
+        return is_device_healthy(self._deadline[device_name] - DEVICE_HEALTH_TIMEOUT, timestamp_now)
+
+    def _transition(self, monitor_db, device_name: str, up: bool, timestamp_now: float):
+        changed, _ = commit_device_transition(monitor_db, device_name, up, timestamp_now)
+        return changed
+
+    def report(self, device_name: str, timestamp: float):
+        """ Device basic report is saved in fullinfo db, called on request path so no io here """
+        timestamp_now = time.time()
+        with self._cond:
+            self._set_deadline(device_name, timestamp + DEVICE_HEALTH_TIMEOUT)
+            if self._up.get(device_name) or not self._is_healthy(device_name, timestamp_now):
+                return
+            self._up[device_name] = True
+            self._pending_up.append(device_name)
+            self._cond.notify()
+
+    def _commit_pending_up(self, pending_list: list):
+        monitor_db = get_device_db('MONITOR')
+        timestamp_now = time.time()
+        for device_name in pending_list:
+            self._transition(monitor_db, device_name, True, timestamp_now)
+
+    def _pop_expired(self, timestamp_now: float) -> list:
+        expired_list = []
+        while self._heap and self._heap[0][0] <= timestamp_now:
+            deadline, device_name = heapq.heappop(self._heap)
+            if self._deadline.get(device_name) == deadline and self._up.get(device_name):
+                expired_list.append(device_name)
+        return expired_list
+
+    def _expire(self, expired_list: list):
+        """ Fire down event of expired devices, device reported to other process gets a new deadline instead """
+        fullinfo_db = get_device_db('FULLINFO')
+        monitor_db = get_device_db('MONITOR')
+        timestamp_dict = {data['name']: data['timestamp'] for data in
+                          fullinfo_db.get_many_by_filter({'name': {'$in': expired_list}}, ['name', 'timestamp'])}
+        timestamp_now = time.time()
+        down_list = []
+        with self._cond:
+            for device_name in expired_list:
+                if device_name not in timestamp_dict:
+                    # Device is deleted
+                    self._deadline.pop(device_name, None)
+                    self._up.pop(device_name, None)
+                    continue
+                self._set_deadline(device_name, timestamp_dict[device_name] + DEVICE_HEALTH_TIMEOUT)
+                if self._up.get(device_name) and not self._is_healthy(device_name, timestamp_now):
+                    self._up[device_name] = False
+                    down_list.append(device_name)
+        for device_name in down_list:
+            self._transition(monitor_db, device_name, False, timestamp_now)
+        return
+
+    def reconcile(self):
+        """
+        Rebuild state from fullinfo and monitor db, and fix monitor db if it differs
+        Output: {"total": 100, "changed": 1}
+        """
+        fullinfo_db = get_device_db('FULLINFO')
+        monitor_db = get_device_db('MONITOR')
+        monitor_state = load_monitor_state(monitor_db)
+        fullinfo_list = list(fullinfo_db.iter_all_elements(projection=['name', 'timestamp']))
+        timestamp_now = time.time()
+        change_list = []
+        with self._cond:
+            name_set = set()
+            for device_dict in fullinfo_list:
+                device_name = device_dict['name']
+                name_set.add(device_name)
+                self._set_deadline(device_name, device_dict['timestamp'] + DEVICE_HEALTH_TIMEOUT)
+                device_health = self._is_healthy(device_name, timestamp_now)
+                self._up[device_name] = device_health
+                if monitor_state.get(device_name) != device_health:
+                    change_list.append((device_name, device_health))
+            for device_name in set(self._deadline) - name_set:
+                del self._deadline[device_name]
+                self._up.pop(device_name, None)
+        changed = sum(self._transition(monitor_db, device_name, up, timestamp_now) for device_name, up in change_list)
+        res_data = {'total': len(fullinfo_list), 'changed': changed}
+        LOGGER.info(f"Reconcile device health complete: {res_data}")
+        return res_data
+
+    def _run(self):
+        next_reconcile = 0
+        while True:
+            with self._cond:
+                timeout = next_reconcile - time.monotonic()
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - time.time())
+                if timeout > 0 and not self._stopped and not self._pending_up:
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                expired_list = self._pop_expired(time.time())
+                pending_list, self._pending_up = self._pending_up, []
+            try:
+                if pending_list:
+                    self._commit_pending_up(pending_list)
+                if expired_list:
+                    self._expire(expired_list)
+                if time.monotonic() >= next_reconcile:
+                    next_reconcile = time.monotonic() + self.reconcile_interval
+                    self.reconcile()
+            except Exception as exc:
+                LOGGER.error(f"Device health scheduler error, detail: {exc!r}")
+
+    def start(self):
+        LOGGER.warning(f"Start device health scheduler, reconcile interval: {self.reconcile_interval}")
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='health-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def start_health_scheduler():
+    """ Start scheduler when settings HEALTH_SCHEDULER is set """
+    global SCHEDULER
+    scheduler_setting = settings.get('HEALTH_SCHEDULER', {})
+    if not scheduler_setting or SCHEDULER is not None:
+        return
+    SCHEDULER = HealthScheduler(scheduler_setting.get('RECONCILE_INTERVAL', HEALTH_RECONCILE_INTERVAL))
+    SCHEDULER.start()
+
+
+def report_device_health(device_name: str, timestamp: float):
+    """ Feed basic report to scheduler, do nothing when scheduler is not running """
+    if SCHEDULER is not None:
+        SCHEDULER.report(device_name, timestamp)
@@ -0,0 +1,140 @@
+import json
+import time
+import httpx
+import asyncio
+import logging
+import threading
+
+from dynaconf import settings
+from pymongo import UpdateOne
+
+from app_lib.mongo_utility import AsyncDataLoader
+
+# Setting Logger
+LOGGER = logging.getLogger(__name__)
+
+# Max concurrent probes and deadline of each probe in seconds
+IGATE_PROBE_CONCURRENCY = 50
+IGATE_PROBE_TIMEOUT = 3
+
+# Liveness cache on request path, enabled by settings IGATE_STATUS_CACHE: {"REFRESH_INTERVAL": 10, "MAX_AGE": 30}
+# gw_name -> {"status": True, "device_list": [...], "checked_at": <timestamp>}
+_IGATE_STATUS = {}
+_REFRESH_STOP = threading.Event()
+_REFRESH_THREAD = None
+
+
+async def probe_igate(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, gw_ip: str, gw_port: str, deadline: float):
+    """ Async version of check_igate_online, return (is_online, device_list) """
+    req_url = f"http://{gw_ip}:{gw_port}/hermesvpn/client"
+    async with semaphore:
+        try:
+            res = await asyncio.wait_for(client.get(req_url), deadline)
+        except (httpx.HTTPError, asyncio.TimeoutError) as exc:
+            LOGGER.error(f"iGate is not online now, ip: {req_url}, detail: {exc!r}")
+            return False, []
+        except Exception as exc:
+            # ex: invalid url from broken ip/port in gwpool, treat as offline
+            LOGGER.error(f"Probe iGate error, ip: {req_url}, detail: {exc!r}")
+            return False, []
+    if res.status_code >= 210:
+        return True, ""
+    try:
+        return True, res.json()
+    except json.decoder.JSONDecodeError:
+        return True, res.text
+
+
+async def sweep_igate_status(concurrency: int = IGATE_PROBE_CONCURRENCY, deadline: float = IGATE_PROBE_TIMEOUT):
+    """
+    Probe all iGate in gwpool concurrently and write status changes with one bulk update
+    Output:
+    {
+      "gw_name": {"status": True, "device_list": [...], "checked_at": <timestamp>}
+    }
+    """
+    db = AsyncDataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
+                         settings['MONGO']['GWPOOL']['DB'], settings['MONGO']['GWPOOL']['COL'])
+    gw_list = await db.get_all_elements(['name', 'ip', 'port', 'status'])
+
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=deadline) as client:
+        # One broken entry should not abort the whole sweep
+        results = await asyncio.gather(*[probe_igate(client, semaphore, gw.get('ip'), gw.get('port'), deadline)
+                                         for gw in gw_list], return_exceptions=True)
+
+    checked_at = time.time()
+    res_data = {}
+    update_list = []
+    for gw, result in zip(gw_list, results):
+        if isinstance(result, BaseException):
+            LOGGER.error(f"Probe iGate ({gw['name']}) error, detail: {result!r}")
+            result = (False, [])
+        is_online, data = result
+        res_data[gw['name']] = {'status': is_online, 'device_list': data, 'checked_at': checked_at}
+        if is_online != gw.get('status'):
+            LOGGER.warning(f"iGate ({gw['name']}) online status has changed, before: {gw.get('status')}, after: {is_online}")
+            update_list.append(UpdateOne({'name': gw['name']}, {'$set': {'status': is_online}}))
+
+    res = await db.bulk_write(update_list)
+    if res['errors']:
+        LOGGER.error(f"Update iGate status error: {res['errors']}")
+    LOGGER.info(f"iGate sweep complete, total: {len(gw_list)}, changed: {len(update_list)}")
+    return res_data
+
+
+def check_all_igate_online():
+    """ Sync entry of sweep_igate_status, used by scheduled job """
+    return asyncio.run(sweep_igate_status())
+
+
+def get_igate_cache_setting(key: str, default):
+    return settings.get('IGATE_STATUS_CACHE', {}).get(key, default)
+
+
+def get_cached_igate_status(gw_name: str):
+    """ Get liveness of iGate in memory, None when cache is disabled, missing or older than MAX_AGE """
+    if not settings.get('IGATE_STATUS_CACHE', {}):
+        return None
+    entry = _IGATE_STATUS.get(gw_name)
+    if entry is None or time.time() - entry['checked_at'] > get_igate_cache_setting('MAX_AGE', 30):
+        return None
+    return entry
+
+
+def set_cached_igate_status(gw_name: str, is_online: bool, device_list):
+    """ Save liveness of iGate probed on request path """
+    _IGATE_STATUS[gw_name] = {'status': is_online, 'device_list': device_list, 'checked_at': time.time()}
+
+
+def refresh_igate_status_loop(interval: float):
+    """ Refresh all iGate liveness in background until stop """
+    global _IGATE_STATUS
+    while not _REFRESH_STOP.is_set():
+        try:
+            # Replace whole dict, iGate deleted from gwpool will be dropped
+            _IGATE_STATUS = check_all_igate_online()
+        except Exception as exc:
+            LOGGER.error(f"Refresh iGate status error, detail: {exc!r}")
+        _REFRESH_STOP.wait(interval)
+
+
+def start_igate_status_refresher():
+    """ Start background refresher when IGATE_STATUS_CACHE is set """
+    global _REFRESH_THREAD
+    if not settings.get('IGATE_STATUS_CACHE', {}) or _REFRESH_THREAD is not None:
+        return
+    interval = get_igate_cache_setting('REFRESH_INTERVAL', 10)
+    LOGGER.warning(f"Start iGate status refresher, interval: {interval}")
+    _REFRESH_STOP.clear()
+    _REFRESH_THREAD = threading.Thread(target=refresh_igate_status_loop, args=(interval,), name='igate-refresher', daemon=True)
+    _REFRESH_THREAD.start()
+
+
+def stop_igate_status_refresher():
+    global _REFRESH_THREAD
+    _REFRESH_STOP.set()
+    if _REFRESH_THREAD is not None:
+        _REFRESH_THREAD.join()
+        _REFRESH_THREAD = None
@@ -0,0 +1,101 @@
+import logging
+
+from dynaconf import settings
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import PyMongoError
+
+from app_lib.mongo_utility import DataLoader
+
+# Setting Logger
+LOGGER = logging.getLogger(__name__)
+
+# Index spec of each collection:
+# (setting path of db, setting path of col, index list), path is under settings['MONGO']
+# ex: ('DEVICE', 'DEVICE.FULLINFO') --> settings['MONGO']['DEVICE']['DB'], settings['MONGO']['DEVICE']['FULLINFO']['COL']
+INDEX_SPEC = [
+    ('DEVICE', 'DEVICE.FULLINFO', [IndexModel([('name', ASCENDING)]),
+                                   IndexModel([('health_shards', ASCENDING), ('health_shard', ASCENDING)])]),
+    ('DEVICE', 'DEVICE.MANAGEMENT', [IndexModel([('name', ASCENDING), ('organization', ASCENDING)]),
+                                     IndexModel([('organization', ASCENDING), ('name', ASCENDING)])]),
+    ('DEVICE', 'DEVICE.MANUFACTURER', [IndexModel([('name', ASCENDING)])]),
+    ('DEVICE', 'DEVICE.STAGING', [IndexModel([('name', ASCENDING)])]),
+    ('DEVICE', 'DEVICE.MONITOR', [IndexModel([('name', ASCENDING)])]),
+    ('DEVICE', 'DEVICE.LEASE', [IndexModel([('name', ASCENDING)], unique=True),
+                                IndexModel([('expire_at', ASCENDING)], expireAfterSeconds=0)]),
+    ('MANAGEMENT', 'MANAGEMENT', [IndexModel([('name', ASCENDING)])]),
+    ('ISP_CACHE', 'ISP_CACHE', [IndexModel([('name', ASCENDING)]),
+                                IndexModel([('expire_at', ASCENDING)], expireAfterSeconds=0)]),
+    ('GWPOOL', 'GWPOOL', [IndexModel([('name', ASCENDING)])]),
+    ('UPGRADE', 'UPGRADE', [IndexModel([('name', ASCENDING)])]),
+    ('TUNNEL.EVPN', 'TUNNEL.EVPN.GROUP', [IndexModel([('name', ASCENDING)])]),
+]
+
+# Query patterns used in code, checked by report_collection_scans()
+# (setting path of db, setting path of col, filter)
+QUERY_SPEC = [
+    ('DEVICE', 'DEVICE.FULLINFO', {'name': ''}),
+    ('DEVICE', 'DEVICE.FULLINFO', {'health_shards': 0, 'health_shard': 0}),
+    ('DEVICE', 'DEVICE.MANAGEMENT', {'name': ''}),
+    ('DEVICE', 'DEVICE.MANAGEMENT', {'name': '', 'organization': ''}),
+    ('DEVICE', 'DEVICE.MANAGEMENT', {'organization': ''}),
+    ('DEVICE', 'DEVICE.MANUFACTURER', {'name': ''}),
+    ('DEVICE', 'DEVICE.STAGING', {'name': ''}),
+    ('DEVICE', 'DEVICE.MONITOR', {'name': ''}),
+    ('MANAGEMENT', 'MANAGEMENT', {'name': ''}),
+    ('ISP_CACHE', 'ISP_CACHE', {'name': ''}),
+    ('GWPOOL', 'GWPOOL', {'name': ''}),
+    ('TUNNEL.EVPN', 'TUNNEL.EVPN.GROUP', {'name': ''}),
+]
+
+
+def get_mongo_setting(path: str, key: str) -> str:
+    """ Get settings['MONGO'][path...][key], ex: get_mongo_setting('DEVICE.FULLINFO', 'COL') """
+    data = settings['MONGO']
+    for p in path.split('.'):
+        data = data[p]
+    return data[key]
+
+
+def get_spec_db(db_path: str, col_path: str) -> DataLoader:
+    """ Get DataLoader of spec entry """
+    return DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
+                      get_mongo_setting(db_path, 'DB'), get_mongo_setting(col_path, 'COL'))
+
+
+def setup_db_indexes():
+    """ Create indexes in INDEX_SPEC, collections which index exists are skipped by mongo """
+    LOGGER.warning('Setup db indexes')
+    for db_path, col_path, index_models in INDEX_SPEC:
+        try:
+            db = get_spec_db(db_path, col_path)
+        except KeyError:
+            # Optional collection, ex: DEVICE.LEASE is only used in partitioned health checking
+            LOGGER.warning(f"Skip index of {col_path}, collection is not set")
+            continue
+        index_names = db.ensure_indexes(index_models)
+        LOGGER.info(f"Index of {db.db_name}.{db.db_col}: {index_names}")
+    LOGGER.warning('Setup db indexes complete')
+
+
+def report_collection_scans():
+    """
+    Explain the queries in QUERY_SPEC and report which would use collection scan
+    Output: [{"db": "device", "col": "fullinfo", "filter": {"name": ""}, "stages": ["COLLSCAN"]}]
+    """
+    res_data = []
+    for db_path, col_path, filter_dict in QUERY_SPEC:
+        try:
+            db = get_spec_db(db_path, col_path)
+        except KeyError:
+            LOGGER.warning(f"Skip query check of {col_path}, collection is not set")
+            continue
+        try:
+            stages = db.explain_stages(filter_dict)
+        except (PyMongoError, KeyError) as exc:
+            # ex: explain is not permitted, or unknown plan format, only a report so never block startup
+            LOGGER.error(f"Explain query error, {db.db_name}.{db.db_col}, filter keys: {list(filter_dict)}, detail: {exc!r}")
+            continue
+        if 'COLLSCAN' in stages:
+            LOGGER.warning(f"Query would use collection scan, {db.db_name}.{db.db_col}, filter keys: {list(filter_dict)}")
+            res_data.append({'db': db.db_name, 'col': db.db_col, 'filter': filter_dict, 'stages': stages})
+    return res_data
@@ -0,0 +1,111 @@
+import logging
+import ipaddress
+
+from pymongo import ASCENDING, IndexModel
+
+from app_lib.allocator_utility import IdAllocator
+from app_lib.ipqueue_utility import get_usable_ip_list
+from app_lib.mongo_utility import DataLoader
+from core.ipqueue_config import (CONFIG, MONGO_CONF)
+
+# Setting Logger
+LOGGER = logging.getLogger(__name__)
+
+
+class IPPool():
+    """
+    Persistent ip pool over many subnets, shared by all workers.
+    Each subnet is an IdAllocator over the index of its usable ip list, so the pool
+    stores one small document per subnet instead of one document per address.
+    """
+    def __init__(self, db, pool_name: str, subnet_list: list, ip_rule=None):
+        self.db = db
+        self.pool_name = pool_name
+        self.subnet_list = [ipaddress.ip_network(subnet) for subnet in subnet_list]
+        self.ip_rule = ip_rule
+        self._ip_list = {}
+        self._ip_index = {}
+        self._allocators = {}
+        for subnet in self.subnet_list:
+            ip_list = get_usable_ip_list(subnet, ip_rule)
+            self._ip_list[subnet] = ip_list
+            self._ip_index[subnet] = {ip: i for i, ip in enumerate(ip_list)}
+            self._allocators[subnet] = IdAllocator(db, f"{pool_name}:{subnet}", 0, len(ip_list) - 1)
+
+    def _find_subnet(self, ip: str):
+        address = ipaddress.ip_address(ip)
+        for subnet in self.subnet_list:
+            if address in subnet:
+                return subnet
+        return None
+
+    def setup(self, used_ips=None):
+        """
+        Create subnet documents if not exist
+        used_ips: ip allocated already, ex: ip in ipqueue collection when migrating
+        """
+        used_index = {subnet: [] for subnet in self.subnet_list}
+        for ip in used_ips or []:
+            subnet = self._find_subnet(ip)
+            if subnet is not None and ip in self._ip_index[subnet]:
+                used_index[subnet].append(self._ip_index[subnet][ip])
+        for subnet, allocator in self._allocators.items():
+            allocator.setup(used_index[subnet])
+        return
+
+    def allocate(self):
+        """ Get a free ip, the first subnet first. Return None when pool is exhausted """
+        for subnet, allocator in self._allocators.items():
+            index = allocator.allocate()
+            if index is not None:
+                return self._ip_list[subnet][index]
+        LOGGER.error(f"IP pool ({self.pool_name}) is exhausted")
+        return None
+
+    def release(self, ip: str) -> bool:
+        """ Give back an ip, return False when it is not allocated in this pool """
+        subnet = self._find_subnet(ip)
+        if subnet is None or ip not in self._ip_index[subnet]:
+            LOGGER.error(f"Release ip ({ip}) failed, it is not in ip pool ({self.pool_name})")
+            return False
+        return self._allocators[subnet].release(self._ip_index[subnet][ip])
+
+    def snapshot(self):
+        """
+        Get state of all subnets in one query, used for warm start
+        Output: {"10.0.0.0/24": {"next": 10, "free": [3, 7]}}
+        """
+        name_list = [allocator.name for allocator in self._allocators.values()]
+        data_dict = {d['name']: d for d in self.db.get_many_by_filter({'name': {'$in': name_list}}, ['name', 'next', 'free'])}
+        res_data = {}
+        for subnet, allocator in self._allocators.items():
+            data = data_dict.get(allocator.name, {'next': 0, 'free': []})
+            res_data[str(subnet)] = {'next': data['next'], 'free': data['free']}
+        return res_data
+
+    def free_ips(self, snapshot=None):
+        """ Generator of free ip from snapshot, ex: rebuild local ip queue without per-address query """
+        snapshot = snapshot or self.snapshot()
+        for subnet in self.subnet_list:
+            data = snapshot[str(subnet)]
+            ip_list = self._ip_list[subnet]
+            for index in sorted(data['free']):
+                yield ip_list[index]
+            for index in range(data['next'], len(ip_list)):
+                yield ip_list[index]
+
+    def is_allocated(self, ip: str, snapshot=None) -> bool:
+        subnet = self._find_subnet(ip)
+        if subnet is None or ip not in self._ip_index[subnet]:
+            return False
+        snapshot = snapshot or self.snapshot()
+        data = snapshot[str(subnet)]
+        index = self._ip_index[subnet][ip]
+        return index < data['next'] and index not in data['free']
+
+
+def get_ip_pool(pool_name: str, subnet_list: list, ip_rule=None) -> IPPool:
+    """ Get ip pool in CONFIG['ipqueue']['pool_col'] (default: ippool) """
+    db = DataLoader(MONGO_CONF['ip'], MONGO_CONF['port'], MONGO_CONF['db'], CONFIG['ipqueue'].get('pool_col', 'ippool'))
+    db.ensure_indexes([IndexModel([('name', ASCENDING)])])
+    return IPPool(db, pool_name, subnet_list, ip_rule)
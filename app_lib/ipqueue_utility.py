@@ -1,25 +1,41 @@
 import logging
 import ipaddress
 
+from pymongo import ASCENDING, IndexModel
+
 from app_lib.mongo_utility import DataLoader
 from core.ipqueue_config import (CONFIG, MONGO_CONF, IP_Queue)
 
 # Setting Logger
 LOGGER = logging.getLogger(__name__)
 
+# Default rule of usable address, the last octet in (start, end) and divisible by step
+DEFAULT_IP_RULE = {'start': 1, 'end': 251, 'step': 2}
+
+
+def get_usable_ip_list(subnet, ip_rule=None):
+    """
+    Get usable ip list of subnet by rule
+    ip_rule: {"start": 1, "end": 251, "step": 2}, use CONFIG['ipqueue']['rule'] or DEFAULT_IP_RULE if not set
+    """
+    rule = dict(DEFAULT_IP_RULE, **(ip_rule or CONFIG['ipqueue'].get('rule', {})))
+    res_data = []
+    for ip in ipaddress.ip_network(subnet):
+        tail = int(ip) & 0xff
+        if rule['start'] < tail < rule['end'] and tail % rule['step'] == 0:
+            res_data.append(str(ip))
+    return res_data
+
 
-def setup_ip_queue(subnet):
+def setup_ip_queue(subnet, ip_rule=None):
     """ Setup ip queue """
     LOGGER.warning('Setup ip queue. Wait a moment...')
     db = DataLoader(MONGO_CONF['ip'], MONGO_CONF['port'], MONGO_CONF['db'], CONFIG['ipqueue']['col'])
+    db.ensure_indexes([IndexModel([('ip', ASCENDING)])])
 
-    start_ip = 1
-    end_ip = 251
-    net = ipaddress.ip_network(subnet)
-    _ = db.get_all_elements
-    for ip in net:
-        tail = int(str(ip).split('.')[-1])
-        if tail > start_ip and tail < end_ip and tail % 2 == 0:
-            if not db.check_exist_one({'ip': str(ip)}):
-                IP_Queue.put(str(ip))
+    # Get used ip in one query and compute free ip in memory
+    used_ip_set = {d['ip'] for d in db.iter_many_by_filter({'ip': {'$exists': True}}, ['ip'])}
+    for ip in get_usable_ip_list(subnet, ip_rule):
+        if ip not in used_ip_set:
+            IP_Queue.put(ip)
     LOGGER.warning('Setup ip queue Complete')
@@ -0,0 +1,187 @@
+import logging
+import datetime
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from dynaconf import settings
+from fastapi import HTTPException
+
+from app_lib.cache_utility import TTLCache
+from app_lib.mongo_utility import DataLoader
+from app_lib.rest_utility import send_restful
+
+# Setting Logger
+LOGGER = logging.getLogger(__name__)
+
+# Cache time of isp data, override by settings['MONGO']['ISP_CACHE']['TTL'|'NEGATIVE_TTL'|'MAXSIZE']
+ISP_CACHE_TTL = 7 * 86400
+ISP_CACHE_NEGATIVE_TTL = 600
+ISP_CACHE_MAXSIZE = 10000
+# Max concurrent calls to DETECT_ISP_URL in batch resolution
+ISP_FETCH_CONCURRENCY = 8
+
+_ISP_LRU = None
+_FETCH_EXECUTOR = None
+# Lookups in progress, public_ip -> Future of (status, isp, lat, lon)
+_IN_FLIGHT = {}
+_IN_FLIGHT_LOCK = threading.Lock()
+
+
+def get_isp_cache_setting(key: str, default):
+    return settings['MONGO']['ISP_CACHE'].get(key, default)
+
+
+def get_isp_lru() -> TTLCache:
+    """ Get in-process tier of isp cache """
+    global _ISP_LRU
+    if _ISP_LRU is None:
+        _ISP_LRU = TTLCache(get_isp_cache_setting('TTL', ISP_CACHE_TTL), get_isp_cache_setting('MAXSIZE', ISP_CACHE_MAXSIZE))
+    return _ISP_LRU
+
+
+def get_isp_db() -> DataLoader:
+    """ Get mongo tier of isp cache, data is removed by TTL index on expire_at """
+    return DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
+                      settings['MONGO']['ISP_CACHE']['DB'], settings['MONGO']['ISP_CACHE']['COL'])
+
+
+def fetch_isp_location(public_ip: str):
+    """ Call DETECT_ISP_URL, return (status, isp, lat, lon) """
+    isp_url = settings['DETECT_ISP_URL'] + public_ip
+    try:
+        res_data, res_code = send_restful(isp_url)
+    except HTTPException:
+        res_data, res_code = {}, 0
+    if res_code == 200 and res_data['status'] == 'success':
+        return True, res_data.get('isp'), res_data.get('lat'), res_data.get('lon')
+    else:
+        res_status = res_data.get('status') if isinstance(res_data, dict) else res_data
+        LOGGER.error(f"Call {isp_url} to get location failed")
+        LOGGER.error(f"Res code: {res_code}, res status: {res_status}")
+        return False, "", 0, 0
+
+
+def isp_data_to_result(isp_data: dict):
+    return isp_data['status'], isp_data['isp'], isp_data['lat'], isp_data['lon']
+
+
+def result_to_isp_data(public_ip: str, result) -> dict:
+    """ Generate isp cache document, negative result expires earlier """
+    status, isp_name, lat, lon = result
+    ttl = get_isp_cache_setting('TTL', ISP_CACHE_TTL) if status else get_isp_cache_setting('NEGATIVE_TTL', ISP_CACHE_NEGATIVE_TTL)
+    return {
+        'name': public_ip,
+        'status': status,
+        'isp': isp_name,
+        'lat': lat,
+        'lon': lon,
+        'expire_at': datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl),
+    }
+
+
+def is_valid_isp_data(isp_data: dict, now: datetime.datetime) -> bool:
+    """ Data written before location was cached has no status and expire_at, treat as miss """
+    return bool(isp_data) and 'status' in isp_data and isp_data.get('expire_at', now) > now
+
+
+def cache_isp_data_in_lru(isp_data: dict, now: datetime.datetime):
+    ttl = (isp_data['expire_at'] - now).total_seconds()
+    get_isp_lru().set(isp_data['name'], isp_data_to_result(isp_data), ttl=ttl)
+
+
+def lookup_isp_location(public_ip: str):
+    """ Lookup mongo tier first, then DETECT_ISP_URL and write back both tiers """
+    now = datetime.datetime.utcnow()
+    isp_db = get_isp_db()
+    isp_data = isp_db.get_one_by_name(public_ip)
+    if not is_valid_isp_data(isp_data, now):
+        LOGGER.debug(f"Retrieve location of pubic ip: {public_ip}")
+        isp_data = result_to_isp_data(public_ip, fetch_isp_location(public_ip))
+        isp_db.upsert_one({'name': public_ip}, isp_data)
+        LOGGER.info(f"Write isp_data into isp_db: {isp_data}")
+    cache_isp_data_in_lru(isp_data, now)
+    return isp_data_to_result(isp_data)
+
+
+def run_coalesced(public_ip: str, func):
+    """ Run func(public_ip) once for concurrent callers of same ip, others wait for the result """
+    with _IN_FLIGHT_LOCK:
+        future = _IN_FLIGHT.get(public_ip)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _IN_FLIGHT[public_ip] = future
+
+    if not is_leader:
+        return future.result()
+
+    try:
+        result = func(public_ip)
+        future.set_result(result)
+    except Exception as exc:
+        future.set_exception(exc)
+        raise
+    finally:
+        with _IN_FLIGHT_LOCK:
+            del _IN_FLIGHT[public_ip]
+    return result
+
+
+def get_isp_location(public_ip):
+    """
+    Get server location with isp cache, concurrent lookups of same ip are coalesced into one
+    Output: (status, isp, lat, lon)
+    """
+    found, result = get_isp_lru().get(public_ip)
+    if found:
+        return result
+    return run_coalesced(public_ip, lookup_isp_location)
+
+
+def get_fetch_executor() -> ThreadPoolExecutor:
+    global _FETCH_EXECUTOR
+    if _FETCH_EXECUTOR is None:
+        _FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=ISP_FETCH_CONCURRENCY, thread_name_prefix='isp')
+    return _FETCH_EXECUTOR
+
+
+def get_isp_locations(public_ip_list: list) -> dict:
+    """
+    Batch version of get_isp_location
+    1. in-process tier
+    2. mongo tier with one $in query
+    3. DETECT_ISP_URL concurrently (max ISP_FETCH_CONCURRENCY), write back with one bulk upsert
+    Output: {"1.2.3.4": (status, isp, lat, lon)}
+    """
+    res_data = {}
+    lru = get_isp_lru()
+    miss_list = []
+    for public_ip in set(public_ip_list):
+        found, result = lru.get(public_ip)
+        if found:
+            res_data[public_ip] = result
+        else:
+            miss_list.append(public_ip)
+    if not miss_list:
+        return res_data
+
+    now = datetime.datetime.utcnow()
+    isp_db = get_isp_db()
+    for isp_data in isp_db.get_many_by_filter({'name': {'$in': miss_list}}):
+        if is_valid_isp_data(isp_data, now):
+            cache_isp_data_in_lru(isp_data, now)
+            res_data[isp_data['name']] = isp_data_to_result(isp_data)
+    fetch_list = [public_ip for public_ip in miss_list if public_ip not in res_data]
+    if not fetch_list:
+        return res_data
+
+    LOGGER.debug(f"Retrieve location of pubic ip: {fetch_list}")
+    results = get_fetch_executor().map(lambda public_ip: run_coalesced(public_ip, fetch_isp_location), fetch_list)
+    isp_data_list = [result_to_isp_data(public_ip, result) for public_ip, result in zip(fetch_list, results)]
+    res = isp_db.bulk_upsert([({'name': isp_data['name']}, isp_data) for isp_data in isp_data_list])
+    if res['errors']:
+        LOGGER.error(f"Write isp_data into isp_db error: {res['errors']}")
+    for isp_data in isp_data_list:
+        cache_isp_data_in_lru(isp_data, now)
+        res_data[isp_data['name']] = isp_data_to_result(isp_data)
+    return res_data
@@ -1,82 +1,232 @@
 import time
+import atexit
 import logging
 
+from bson.objectid import ObjectId
 from dynaconf import settings
+from pymongo import UpdateOne
 
-from app_lib.func_utility import send_device_notification, update_db_data
+from app_lib.change_stream_utility import get_view
+from app_lib.fleet_utility import DEVICE_HEALTH_TIMEOUT, UNKNOWN, FleetState
+from app_lib.lease_utility import ShardLease, get_shard
 from app_lib.mongo_utility import DataLoader
+from app_lib.notification_utility import send_device_notification
 
 # Setting Logger
 LOGGER = logging.getLogger(__name__)
 
+# Default of settings HEALTH_PARTITION: {"SHARDS": 16, "LEASE_TTL": 60}
+HEALTH_SHARDS = 16
+HEALTH_LEASE_TTL = 60
 
-def checking_device_procedure():
+_HEALTH_LEASE = None
+
+
+def get_device_db(col_key: str) -> DataLoader:
+    return DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
+                      settings['MONGO']['DEVICE']['DB'], settings['MONGO']['DEVICE'][col_key]['COL'])
+
+
+def get_health_shard_count() -> int:
+    return settings.get('HEALTH_PARTITION', {}).get('SHARDS', HEALTH_SHARDS)
+
+
+def gen_health_shard_fields(device_name: str) -> dict:
     """
-    Description: Checking device health
+    Shard fields saved in fullinfo with basic report, partitioned checking reads only its shards by them
+    Output: {"health_shards": 16, "health_shard": 3}
+    """
+    shard_count = get_health_shard_count()
+    return {'health_shards': shard_count, 'health_shard': get_shard(device_name, shard_count)}
+
+
+def is_in_shards(data: dict, shard_list, shard_count: int) -> bool:
+    """ Use saved shard when it is for shard_count, otherwise hash the name, ex: shard count changed """
+    if data.get('health_shards') == shard_count:
+        return data['health_shard'] in shard_list
+    return get_shard(data['name'], shard_count) in shard_list
+
+
+def is_device_healthy(timestamp: float, timestamp_now: float) -> bool:
+    return abs(timestamp - timestamp_now) < DEVICE_HEALTH_TIMEOUT
+
+
+def load_monitor_state(monitor_db: DataLoader) -> dict:
+    """
+    Load up status of all devices in monitor db with one query
+    Output: {"device_name": True}
+    """
+    return {data['name']: data['up'] for data in monitor_db.iter_all_elements(projection=['name', 'up'])}
+
+
+def notify_device_transition(device_name: str, up: bool, timestamp_now: float, is_new: bool = False):
+    """ Send device up/down notification """
+    if up:
+        LOGGER.warning(f"Device up event, name: {device_name}{', new device' if is_new else ''}, update db and send email.")
+        subject = f"Device {device_name} up"
+        detail_msg = f"Device {device_name} getting online."
+    else:
+        LOGGER.critical(f"Device down event, name: {device_name}, update db and send email.")
+        subject = f"Device {device_name} down"
+        detail_msg = f"Device {device_name} getting offline. Please check device power status or device network status."
+    send_device_notification(device_name, subject, "CRITICAL", detail_msg, timestamp_now)
+    return
+
+
+def notify_committed_transition(device_name: str, up: bool, timestamp_now: float, is_new: bool):
+    """ Notify transition committed by this worker, new device is not notified until it is online """
+    if up or not is_new:
+        notify_device_transition(device_name, up, timestamp_now, is_new)
+    else:
+        LOGGER.warning(f"Device up event, name: {device_name}, new device but down now, insert db.")
+
+
+def commit_monitor_transition(monitor_db: DataLoader, device_name: str, up: bool):
+    """
+    Set up flag of one device only when it changes, concurrent checkers will not both succeed
+    Output: (changed, is_new)
+    """
+    if monitor_db.update_one({'name': device_name, 'up': not up}, {'$set': {'up': up}}):
+        return True, False
+    # No document with old status, insert it when device is new
+    old_data = monitor_db.find_one_and_update({'name': device_name}, {'$setOnInsert': {'name': device_name, 'up': up}},
+                                              upsert=True, return_new=False, projection=['_id'])
+    return old_data is None, old_data is None
+
+
+def commit_device_transition(monitor_db: DataLoader, device_name: str, up: bool, timestamp_now: float):
+    """
+    Commit transition to monitor db, send notification only when this call changed it
+    Output: (changed, is_new)
     """
-    # Step 1. Get fullinfo from db
-    fullinfo_db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
-                             settings['MONGO']['DEVICE']['DB'], settings['MONGO']['DEVICE']['FULLINFO']['COL'])
-
-    monitor_db = DataLoader(settings['MONGO_SERVER']['IP'], settings['MONGO_SERVER']['PORT'],
-                            settings['MONGO']['DEVICE']['DB'], settings['MONGO']['DEVICE']['MONITOR']['COL'])
-    device_fullinfo_list = fullinfo_db.get_all_elements()
-    device_health_old = False
-    device_health_new = False
-    for device_dict in device_fullinfo_list:
-        LOGGER.debug(device_dict)
-        device_name = device_dict['name']
-        # Check device health now
-        timestamp_basic_report = device_dict['timestamp']
-        timestamp_now = time.time()
-        if abs(timestamp_basic_report - timestamp_now) < 90:
-            device_health_new = True
+    changed, is_new = commit_monitor_transition(monitor_db, device_name, up)
+    if changed:
+        notify_committed_transition(device_name, up, timestamp_now, is_new)
+    return changed, is_new
+
+
+def commit_sweep_transitions(monitor_db: DataLoader, transition_list: list) -> set:
+    """
+    Commit transitions of one sweep with one bulk write, conditional like commit_monitor_transition
+    transition_list ex: [("device_a", True, False)]  # (name, up, is_new)
+    Every matched update is tagged with sweep_id, one read finds the devices changed by this sweep
+    Output: {"device_a"}
+    """
+    if not transition_list:
+        return set()
+    sweep_id = ObjectId()
+    update_list = []
+    for device_name, up, is_new in transition_list:
+        if is_new:
+            update_list.append(UpdateOne({'name': device_name},
+                                         {'$setOnInsert': {'name': device_name, 'up': up, 'sweep_id': sweep_id}},
+                                         upsert=True))
         else:
-            device_health_new = False
-
-        monitor_data = monitor_db.get_one_by_name(device_name)
-        if monitor_data:
-            # There is a record in monitor db
-            device_health_old = monitor_data['up']
-            if device_health_old == device_health_new:
-                # Status not change
-                pass
-            elif device_health_old and not device_health_new:
-                # Status changed, old status = True, new status = False
-                # Send api for device down, update db
-                LOGGER.critical(f"Device down event, name: {device_name}, update db and send email.")
-                subject = f"Device {device_name} down"
-                detail_msg = f"Device {device_name} getting offline. Please check device power status or device network status."
-                send_device_notification(device_name, subject, "CRITICAL", detail_msg, timestamp_now)
-                monitor_data['up'] = device_health_new
-                filter_dict = {'name': device_name}
-                _ = update_db_data(monitor_db, filter_dict, monitor_data, "device monitor data")
-            elif not device_health_old and device_health_new:
-                # Status changed, old status = False, new status = True
-                # Send api for device up, update db
-                LOGGER.warning(f"Device up event, name: {device_name}, update db and send email.")
-                subject = f"Device {device_name} up"
-                detail_msg = f"Device {device_name} getting online."
-                send_device_notification(device_name, subject, "CRITICAL", detail_msg, timestamp_now)
-                monitor_data['up'] = device_health_new
-                filter_dict = {'name': device_name}
-                _ = update_db_data(monitor_db, filter_dict, monitor_data, "device monitor data")
+            update_list.append(UpdateOne({'name': device_name, 'up': not up}, {'$set': {'up': up, 'sweep_id': sweep_id}}))
+    res = monitor_db.bulk_write(update_list)
+    if res['errors']:
+        LOGGER.error(f"Commit device transitions error: {res['errors']}")
+    name_list = [device_name for device_name, _, _ in transition_list]
+    return {data['name'] for data in monitor_db.iter_many_by_filter({'name': {'$in': name_list}, 'sweep_id': sweep_id},
+                                                                     ['name'])}
+
+
+def checking_device_procedure(shard_list=None, shard_count: int = 1, lease: ShardLease = None):
+    """
+    Description: Checking device health
+    shard_list: only check devices which get_shard(name, shard_count) in shard_list, None for all devices
+    lease: lease of shard_list, renewed after evaluation, devices in lost shards are skipped
+    1. Load name and timestamp from fullinfo db (or change stream view) into FleetState,
+       fill up flags from monitor db, one query each. With shard_list only the devices saved with these shards,
+       or without shard fields of shard_count, are read
+    2. Evaluate health of all devices at once
+    3. Commit all changes with one bulk write of conditional updates, notify only the devices changed by it,
+       so health scheduler and other workers changing the same device will not alert twice
+    Output:
+    {
+      "total": 100, "up": 1, "down": 2, "new": 0, "skipped": 0, "unchanged": 97,
+      "timing": {"load": 0.05, "evaluate": 0.001, "write": 0.01, "total": 0.061}
+    }
+    """
+    time_start = time.monotonic()
+    fullinfo_db = get_device_db('FULLINFO')
+    monitor_db = get_device_db('MONITOR')
+    # Only name, timestamp and shard are needed, read change stream view or stream them from db
+    fullinfo_fields = ['name', 'timestamp', 'health_shards', 'health_shard']
+    fullinfo_view = get_view('FULLINFO')
+    if fullinfo_view is not None:
+        device_fullinfo_list = fullinfo_view.records(fullinfo_fields)
+    elif shard_list is not None:
+        shard_filter = {'$or': [{'health_shards': shard_count, 'health_shard': {'$in': list(shard_list)}},
+                                # Devices not reported since shard fields or shard count changed
+                                {'health_shards': {'$ne': shard_count}}]}
+        device_fullinfo_list = fullinfo_db.iter_many_by_filter(shard_filter, fullinfo_fields)
+    else:
+        device_fullinfo_list = fullinfo_db.iter_all_elements(projection=['name', 'timestamp'])
+    if shard_list is not None:
+        device_fullinfo_list = (d for d in device_fullinfo_list if is_in_shards(d, shard_list, shard_count))
+    fleet = FleetState.from_records(device_fullinfo_list)
+    if shard_list is not None:
+        fleet.load_up_flags(monitor_db.iter_many_by_filter({'name': {'$in': fleet.names}}, ['name', 'up']))
+    else:
+        fleet.load_up_flags(monitor_db.iter_all_elements(projection=['name', 'up']))
+    time_load = time.monotonic()
+
+    timestamp_now = time.time()
+    health = fleet.evaluate(timestamp_now, DEVICE_HEALTH_TIMEOUT)
+    changed_rows = fleet.transitions(health)
+    if lease is not None and changed_rows:
+        # Sweep may run longer than lease ttl, other worker owns the lost shards now
+        owned_shards = lease.renew()
+        changed_rows = [row for row in changed_rows if get_shard(fleet.names[row], shard_count) in owned_shards]
+    summary = {'total': len(fleet), 'up': 0, 'down': 0, 'new': 0, 'skipped': 0,
+               'unchanged': len(fleet) - len(changed_rows)}
+    time_evaluate = time.monotonic()
+    transition_list = [(fleet.names[row], bool(health[row]), fleet.up[row] == UNKNOWN) for row in changed_rows]
+    changed_names = commit_sweep_transitions(monitor_db, transition_list)
+    for device_name, device_health_new, is_new in transition_list:
+        if device_name not in changed_names:
+            # Changed by health scheduler or other worker after monitor state was loaded
+            summary['skipped'] += 1
+            continue
+        if is_new:
+            summary['new'] += 1
         else:
-            # No data in monitor db
-            tmp_data = {}
-            tmp_data['name'] = device_name
-            if device_health_new:
-                # New device online, send api for Device UP, Write db
-                LOGGER.warning(f"Device up event, name: {device_name}, new device, insert db and send email.")
-                subject = f"Device {device_name} up"
-                detail_msg = f"Device {device_name} getting online."
-                send_device_notification(device_name, subject, "CRITICAL", detail_msg, timestamp_now)
-                tmp_data['up'] = True
-                monitor_db.write_one(tmp_data)
-            else:
-                # New device, but not online, Wait next time check and write db
-                LOGGER.warning(f"Device up event, name: {device_name}, new device but down now, insert db.")
-                tmp_data['up'] = False
-                monitor_db.write_one(tmp_data)
+            summary['up' if device_health_new else 'down'] += 1
+        notify_committed_transition(device_name, device_health_new, timestamp_now, is_new)
+    time_end = time.monotonic()
+    summary['timing'] = {
+        'load': round(time_load - time_start, 4),
+        'evaluate': round(time_evaluate - time_load, 4),
+        'write': round(time_end - time_evaluate, 4),
+        'total': round(time_end - time_start, 4),
+    }
+    LOGGER.info(f"Checking device health complete: {summary}")
+    return summary
 
-    return
+
+def get_health_lease() -> ShardLease:
+    global _HEALTH_LEASE
+    if _HEALTH_LEASE is None:
+        partition_setting = settings.get('HEALTH_PARTITION', {})
+        _HEALTH_LEASE = ShardLease(get_device_db('LEASE'), 'health', get_health_shard_count(),
+                                   partition_setting.get('LEASE_TTL', HEALTH_LEASE_TTL))
+        # Give back shards on exit, so other workers take them over without waiting for expiry
+        atexit.register(_HEALTH_LEASE.release_all)
+    return _HEALTH_LEASE
+
+
+def partitioned_checking_device_procedure():
+    """
+    Description: Checking device health of shards leased by this worker, run it in every replica
+    Job interval must be shorter than LEASE_TTL, otherwise the leases expire between runs
+    Output: summary of checking_device_procedure with "shards", None when no shard is leased
+    """
+    lease = get_health_lease()
+    shard_list = lease.refresh()
+    if not shard_list:
+        LOGGER.info(f"No health shard leased by {lease.owner}, skip checking")
+        return None
+    summary = checking_device_procedure(shard_list, lease.shard_count, lease)
+    summary['shards'] = sorted(shard_list)
+    return summary
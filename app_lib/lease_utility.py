@@ -0,0 +1,99 @@
+import os
+import re
+import zlib
+import uuid
+import socket
+import logging
+import datetime
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
+
+# Setting Logger
+LOGGER = logging.getLogger(__name__)
+
+
+def get_shard(name: str, shard_count: int) -> int:
+    """ Stable shard of name, same in every process and python version """
+    return zlib.crc32(name.encode()) % shard_count
+
+
+class ShardLease():
+    """
+    Split work into shards and let workers claim them with lease documents in db:
+    {"name": "health:3", "owner": "host:1234:9f1c2a7e", "expire_at": <datetime>}    # Shard lease
+    {"name": "health:member:host:1234:9f1c2a7e", "expire_at": <datetime>}         # Live worker
+    A lease is taken over when it expires, so shards of a dead worker move to others after ttl seconds.
+    Each worker keeps at most ceil(shard_count / live workers) shards, extra shards are released.
+    Claim relies on unique index on name, a claim racing an existing lease fails on insert, it is created here.
+    """
+    def __init__(self, db, prefix: str, shard_count: int, ttl: float = 60):
+        self.db = db
+        self.prefix = prefix
+        self.shard_count = shard_count
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.shards = set()
+        self.db.ensure_indexes([IndexModel([('name', ASCENDING)], unique=True),
+                                IndexModel([('expire_at', ASCENDING)], expireAfterSeconds=0)])
+
+    def _lease_name(self, shard: int) -> str:
+        return f"{self.prefix}:{shard}"
+
+    def _expire_at(self, now: datetime.datetime) -> datetime.datetime:
+        return now + datetime.timedelta(seconds=self.ttl)
+
+    def claim(self, shard: int, now: datetime.datetime = None) -> bool:
+        """ Take or renew lease of shard, return False when it is held by other worker """
+        now = now or datetime.datetime.utcnow()
+        filter_dict = {'name': self._lease_name(shard), '$or': [{'owner': self.owner}, {'expire_at': {'$lte': now}}]}
+        update_data = {'$set': {'owner': self.owner, 'expire_at': self._expire_at(now)}}
+        try:
+            self.db.find_one_and_update(filter_dict, update_data, upsert=True, projection=['_id'])
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def renew(self, now: datetime.datetime = None) -> set:
+        """ Renew owned leases, drop lost ones, return shards still owned """
+        now = now or datetime.datetime.utcnow()
+        self.shards = {shard for shard in self.shards if self.claim(shard, now)}
+        return set(self.shards)
+
+    def release(self, shard: int):
+        self.db.delete_one_by_filter({'name': self._lease_name(shard), 'owner': self.owner})
+        self.shards.discard(shard)
+
+    def release_all(self):
+        for shard in list(self.shards):
+            self.release(shard)
+        self.db.delete_one_by_name(f"{self.prefix}:member:{self.owner}")
+
+    def heartbeat(self, now: datetime.datetime) -> int:
+        """ Renew member document, return count of live workers """
+        self.db.upsert_one({'name': f"{self.prefix}:member:{self.owner}"}, {'expire_at': self._expire_at(now)})
+        filter_dict = {'name': {'$regex': f"^{re.escape(self.prefix)}:member:"}, 'expire_at': {'$gt': now}}
+        return max(len(self.db.get_many_by_filter(filter_dict, ['_id'])), 1)
+
+    def refresh(self) -> set:
+        """
+        Renew owned leases, release extra shards and claim free ones, call it more often than ttl
+        Output: {0, 3, 5}
+        """
+        now = datetime.datetime.utcnow()
+        target = -(-self.shard_count // self.heartbeat(now))
+        # Renew owned shards first, lost ones are taken over by others
+        self.renew(now)
+        for shard in sorted(self.shards, reverse=True)[:max(len(self.shards) - target, 0)]:
+            self.release(shard)
+
+        # Shards from own position first, so workers do not all race for shard 0
+        start = get_shard(self.owner, self.shard_count)
+        for i in range(self.shard_count):
+            if len(self.shards) >= target:
+                break
+            shard = (start + i) % self.shard_count
+            if shard not in self.shards and self.claim(shard, now):
+                self.shards.add(shard)
+        LOGGER.debug(f"Lease ({self.prefix}) owner: {self.owner}, shards: {sorted(self.shards)}, target: {target}")
+        return set(self.shards)
@@ -0,0 +1,179 @@
+import sys
+import bson
+import bisect
+import logging
+import threading
+
+from pymongo import monitoring
+
+from app_lib.cache_utility import get_cache_stats
+from app_lib.custom_api_router import APIRouter
+from app_lib.notification_utility import get_notification_stats
+
+# Setting Logger
+LOGGER = logging.getLogger(__name__)
+
+# Upper bound of latency histogram buckets in ms, the last bucket is +Inf
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# Modules skipped when searching the caller of a mongo command
+_SKIP_MODULE_PREFIX = ('pymongo', 'bson', 'concurrent', 'threading', 'app_lib.mongo_utility',
+                       'app_lib.cache_utility', 'app_lib.metrics_utility')
+
+# Metrics endpoints, the service app (outside app_lib) must mount it with the other routers:
+#   from app_lib import metrics_utility
+#   app.include_router(metrics_utility.router, tags=['metrics'])
+router = APIRouter()
+
+
+class LatencyHistogram():
+    """ Cumulative latency histogram in ms """
+    def __init__(self):
+        self.count = 0
+        self.sum_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, value_ms):
+        self.count += 1
+        self.sum_ms += value_ms
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, value_ms)] += 1
+
+    def to_dict(self):
+        bucket_keys = [str(b) for b in LATENCY_BUCKETS_MS] + ['+Inf']
+        return {
+            'count': self.count,
+            'sum_ms': round(self.sum_ms, 3),
+            'avg_ms': round(self.sum_ms / self.count, 3) if self.count else 0,
+            'buckets': dict(zip(bucket_keys, self.buckets)),
+        }
+
+
+def find_call_site():
+    """
+    Get (DataLoader method, caller) of current mongo command, ex: ('get_one_by_name', 'app_lib.func_utility:get_gw_data')
+    Return 'unknown' when it is called from executor thread of AsyncDataLoader.
+    """
+    operation = 'unknown'
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module == 'app_lib.mongo_utility' or module == 'app_lib.cache_utility':
+            # The outermost frame in loader is the method called by user code, skip write_method decorator
+            if frame.f_code.co_name != 'wrapper':
+                operation = frame.f_code.co_name
+        elif not module.startswith(_SKIP_MODULE_PREFIX):
+            return operation, f"{module}:{frame.f_code.co_name}"
+        frame = frame.f_back
+    return operation, 'unknown'
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    Record latency, document count and reply bytes of mongo commands by (namespace, operation, caller)
+    measure_bytes: re-encode every reply to count bytes, it costs cpu on large replies so it is off by default
+    """
+    def __init__(self, measure_bytes=False):
+        self.measure_bytes = measure_bytes
+        self._pending = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        command = event.command
+        if event.command_name == 'getMore':
+            col_name = command.get('collection')
+        else:
+            col_name = command.get(event.command_name)
+        if not isinstance(col_name, str):
+            # Commands without collection, ex: listCollections, ping
+            col_name = ''
+        operation, caller = find_call_site()
+        namespace = f"{event.database_name}.{col_name}"
+        self._pending[(event.connection_id, event.request_id)] = (namespace, event.command_name, operation, caller)
+
+    def succeeded(self, event):
+        key = self._pending.pop((event.connection_id, event.request_id), None)
+        if key is None:
+            return
+        reply = event.reply
+        cursor = reply.get('cursor', {})
+        docs = len(cursor.get('firstBatch', cursor.get('nextBatch', []))) if cursor else reply.get('n', 0)
+        reply_bytes = len(bson.encode(reply)) if self.measure_bytes else 0
+        self._record(key, event.duration_micros, docs, reply_bytes, False)
+
+    def failed(self, event):
+        key = self._pending.pop((event.connection_id, event.request_id), None)
+        if key is None:
+            return
+        self._record(key, event.duration_micros, 0, 0, True)
+
+    def _record(self, key, duration_micros, docs, reply_bytes, is_error):
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = {'errors': 0, 'docs': 0, 'bytes': 0, 'latency': LatencyHistogram()}
+                self._stats[key] = stats
+            stats['latency'].observe(duration_micros / 1000)
+            stats['docs'] += docs
+            stats['bytes'] += reply_bytes
+            if is_error:
+                stats['errors'] += 1
+
+    def snapshot(self):
+        """ Output: list of stats sorted by total latency, the slowest first """
+        res_data = []
+        with self._lock:
+            for (namespace, command, operation, caller), stats in self._stats.items():
+                res_data.append({
+                    'namespace': namespace,
+                    'command': command,
+                    'operation': operation,
+                    'caller': caller,
+                    'errors': stats['errors'],
+                    'docs': stats['docs'],
+                    'bytes': stats['bytes'],
+                    'latency': stats['latency'].to_dict(),
+                })
+        res_data.sort(key=lambda d: d['latency']['sum_ms'], reverse=True)
+        return res_data
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+MONGO_METRICS = None
+
+
+def enable_mongo_metrics(measure_bytes: bool = False):
+    """
+    Register command listener, only the clients created after this call are monitored.
+    Call it before the first DataLoader is created.
+    """
+    global MONGO_METRICS
+    if MONGO_METRICS is None:
+        LOGGER.warning(f"Enable mongo command metrics, measure bytes: {measure_bytes}")
+        MONGO_METRICS = MongoCommandMetrics(measure_bytes)
+        monitoring.register(MONGO_METRICS)
+    return MONGO_METRICS
+
+
+def get_mongo_metrics():
+    """ Get mongo command metrics and read cache stats """
+    res_data = {}
+    res_data['enabled'] = MONGO_METRICS is not None
+    res_data['commands'] = MONGO_METRICS.snapshot() if MONGO_METRICS else []
+    res_data['cache'] = get_cache_stats()
+    return res_data
+
+
+@router.get('/metrics/mongo')
+async def get_mongo_metrics_api():
+    """ Metrics endpoint of mongo commands """
+    return get_mongo_metrics()
+
+
+@router.get('/metrics/notification')
+async def get_notification_metrics_api():
+    """ Metrics endpoint of notification dispatcher, queue depth and send counters """
+    return get_notification_stats()
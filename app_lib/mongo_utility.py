@@ -1,110 +1,468 @@
+import os
+import base64
+import atexit
+import inspect
+import asyncio
 import logging
+import functools
+import itertools
+import threading
 
-from pymongo import MongoClient
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from bson import json_util
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
 
 LOGGER = logging.getLogger(__name__)
 
+# Default options of every pooled client, override with configure_client_pool()
+CLIENT_OPTIONS = {
+    'maxPoolSize': 100,
+    'minPoolSize': 0,
+    'maxIdleTimeMS': 300000,
+    'connect': False,
+}
+
+_CLIENT_POOL = {}
+_CLIENT_POOL_PID = os.getpid()
+_CLIENT_POOL_LOCK = threading.Lock()
+
+# Default batch size of streaming cursor
+ITER_BATCH_SIZE = 1000
+
+# Executor for AsyncDataLoader, sized like the default connection pool
+ASYNC_EXECUTOR_WORKERS = 32
+_ASYNC_EXECUTOR = None
+
+
+def configure_client_pool(**options):
+    """
+    Update default MongoClient options, ex: configure_client_pool(maxPoolSize=50, minPoolSize=5)
+    Only the clients created after this call will use the new options.
+    """
+    CLIENT_OPTIONS.update(options)
+
+
+def _reset_client_pool_after_fork():
+    """ Drop the clients inherited from parent process, MongoClient is not fork-safe """
+    global _CLIENT_POOL_PID, _CLIENT_POOL_LOCK, _ASYNC_EXECUTOR
+    _CLIENT_POOL.clear()
+    # Threads of executor are not copied to child process
+    _ASYNC_EXECUTOR = None
+    _CLIENT_POOL_PID = os.getpid()
+    _CLIENT_POOL_LOCK = threading.Lock()
+
+
+def _freeze_option(value):
+    """ Hashable form of client option, ex: compressors=['zstd'] -> ('zstd',) """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze_option(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze_option(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze_option(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def get_mongo_client(mongodb_ip, mongodb_port, **options):
+    """ Get a shared MongoClient from registry, key: (ip, port, options) """
+    client_options = dict(CLIENT_OPTIONS, **options)
+    key = (mongodb_ip, mongodb_port, _freeze_option(client_options))
+    if _CLIENT_POOL_PID != os.getpid():
+        # Forked by a path which bypass os.register_at_fork, ex: os.fork() in C extension
+        _reset_client_pool_after_fork()
+
+    client = _CLIENT_POOL.get(key)
+    if client is None:
+        with _CLIENT_POOL_LOCK:
+            client = _CLIENT_POOL.get(key)
+            if client is None:
+                LOGGER.info(f"Create mongo client, host: {mongodb_ip}:{mongodb_port}, options: {client_options}")
+                client = MongoClient(mongodb_ip, mongodb_port, **client_options)
+                _CLIENT_POOL[key] = client
+    return client
+
+
+def _get_async_executor():
+    """ Get the shared executor of AsyncDataLoader """
+    global _ASYNC_EXECUTOR
+    if _ASYNC_EXECUTOR is None:
+        with _CLIENT_POOL_LOCK:
+            if _ASYNC_EXECUTOR is None:
+                _ASYNC_EXECUTOR = ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_WORKERS, thread_name_prefix='mongo')
+    return _ASYNC_EXECUTOR
+
+
+def close_all_clients():
+    """ Close all pooled clients, used when process shutdown """
+    global _ASYNC_EXECUTOR
+    if _ASYNC_EXECUTOR is not None:
+        _ASYNC_EXECUTOR.shutdown(wait=False)
+        _ASYNC_EXECUTOR = None
+    with _CLIENT_POOL_LOCK:
+        if _CLIENT_POOL_PID == os.getpid():
+            for client in _CLIENT_POOL.values():
+                client.close()
+        _CLIENT_POOL.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_client_pool_after_fork)
+atexit.register(close_all_clients)
+
+
+def get_value_by_path(data, key_path):
+    """ Get value of dotted key, ex: get_value_by_path({'d': {'seq': 1}}, 'd.seq') -> 1, None when not found """
+    for key in key_path.split('.'):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def encode_page_token(sort_key, reverse, last_value, last_id):
+    """ Encode the last seen data of page into an opaque continuation token """
+    token_data = {'k': sort_key, 'r': reverse, 'v': last_value, 'i': last_id}
+    return base64.urlsafe_b64encode(json_util.dumps(token_data).encode()).decode()
+
+
+def decode_page_token(token):
+    """ Decode continuation token, raise ValueError when token is broken """
+    try:
+        token_data = json_util.loads(base64.urlsafe_b64decode(token.encode()))
+        return token_data['k'], token_data['r'], token_data['v'], token_data['i']
+    except (ValueError, TypeError, KeyError) as exc:
+        raise ValueError(f"Invalid page token: {token}") from exc
+
+
+_WRITE_LISTENERS = []
+
+
+def add_write_listener(listener):
+    """ Register listener(db_name, col_name), called after every write of DataLoader in this process """
+    _WRITE_LISTENERS.append(listener)
+
+
+def write_method(func):
+    """ Decorator of DataLoader write method, notify write listeners even if write failed partially """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            for listener in _WRITE_LISTENERS:
+                listener(self.db_name, self.db_col)
+    return wrapper
+
 
 class DataLoader():
-    def __init__(self, mongodb_ip, mongodb_port, mongodb_db, mongodb_col=""):
+    def __init__(self, mongodb_ip, mongodb_port, mongodb_db, mongodb_col="", **client_options):
         self.db_name = mongodb_db
         self.db_col = mongodb_col
-        self.client = MongoClient(mongodb_ip, mongodb_port)
+        self.client = get_mongo_client(mongodb_ip, mongodb_port, **client_options)
         self.db = self.client[self.db_name]
         if self.db_col:
             self.col = self.db[self.db_col]
 
-    def get_all_elements(self):
-        cursers = self.col.find()
-        res = []
-        for data in cursers:
-            del data['_id']
-            res.append(data)
-        return res
+    def get_all_elements(self, projection=None):
+        res = self.col.find({}, self.build_projection(projection))
+        return list(res)
 
-    def get_all_elements_with_id(self):
-        cursers = self.col.find()
+    def get_all_elements_with_id(self, projection=None):
+        cursers = self.col.find({}, self.build_projection(projection, True))
         return list(cursers)
 
-    def get_all_elements_and_sort(self, filter_name, reverse):
+    def get_all_elements_and_sort(self, filter_name, reverse, projection=None):
         if reverse:
             # From big to small
-            res_data = list(self.col.find({}, {'_id': False}).sort(filter_name, -1))
+            res_data = list(self.col.find({}, self.build_projection(projection)).sort(filter_name, -1))
         else:
-            res_data = list(self.col.find({}, {'_id': False}).sort(filter_name, 1))
+            res_data = list(self.col.find({}, self.build_projection(projection)).sort(filter_name, 1))
         return res_data
 
-    def get_many_by_name(self, name):
-        res = self.col.find({"name": name})
+    @staticmethod
+    def build_projection(projection, with_id=False):
+        """ projection ex: ['name', 'timestamp'] or {'name': True, 'timestamp': True}, hide _id when with_id is False """
+        if projection is None:
+            return None if with_id else {'_id': False}
+        if not isinstance(projection, dict):
+            projection = {key: True for key in projection}
+        if with_id:
+            return projection
+        return dict({'_id': False}, **projection)
+
+    def iter_many_by_filter(self, filter_dict, projection=None, batch_size=ITER_BATCH_SIZE, limit=0, sort=None,
+                            with_id=False):
+        """
+        Generator version of get_many_by_filter, yield data batch by batch from server
+        sort ex: [('timestamp', -1)]
+        limit: max count of data, 0 is no limit
+        """
+        cursor = self.col.find(filter_dict, self.build_projection(projection, with_id),
+                               batch_size=batch_size, limit=limit)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            for data in cursor:
+                yield data
+        finally:
+            # Release server cursor when generator stop early
+            cursor.close()
+
+    def iter_all_elements(self, projection=None, batch_size=ITER_BATCH_SIZE, limit=0):
+        """ Generator version of get_all_elements """
+        return self.iter_many_by_filter({}, projection, batch_size, limit)
+
+    def iter_all_elements_with_id(self, projection=None, batch_size=ITER_BATCH_SIZE, limit=0):
+        """ Generator version of get_all_elements_with_id """
+        return self.iter_many_by_filter({}, projection, batch_size, limit, with_id=True)
+
+    def iter_all_elements_and_sort(self, filter_name, reverse, projection=None, batch_size=ITER_BATCH_SIZE, limit=0):
+        """ Generator version of get_all_elements_and_sort """
+        sort = [(filter_name, -1 if reverse else 1)]
+        return self.iter_many_by_filter({}, projection, batch_size, limit, sort)
+
+    @staticmethod
+    def build_keyset_filter(sort_key, reverse, last_value, last_id):
+        """
+        Filter of the data after (last_value, last_id) in (sort_key, _id) order.
+        $gt/$lt only match values of the same type, so null/missing sort_key, which is the smallest, is matched
+        explicitly, ex: organization is None after parkinglot reset.
+        """
+        compare = '$lt' if reverse else '$gt'
+        same_value = {sort_key: last_value, '_id': {compare: last_id}}
+        if last_value is None:
+            # Ascending: all non-null data is after null, descending: null is the last
+            return same_value if reverse else {'$or': [same_value, {sort_key: {'$ne': None}}]}
+        or_list = [{sort_key: {compare: last_value}}, same_value]
+        if reverse:
+            or_list.append({sort_key: None})
+        return {'$or': or_list}
+
+    def get_page(self, sort_key, page_size, after=None, reverse=False, filter_dict=None, projection=None):
+        """
+        Keyset pagination sorted by (sort_key, _id), cost is not related to the page number
+        sort_key: field or dotted path, values should be one type, null or missing is allowed
+        after: (last_value, last_id) of previous page, None for first page
+        Output: (data_list, after of next page or None when it is last page)
+        """
+        direction = -1 if reverse else 1
+        query = filter_dict or {}
+        if after is not None:
+            keyset_filter = self.build_keyset_filter(sort_key, reverse, *after)
+            query = {'$and': [query, keyset_filter]} if query else keyset_filter
+        if projection is not None:
+            # sort_key and _id are needed for next page, keep them in both inclusion and exclusion projection
+            projection = dict(self.build_projection(projection, True))
+            projection.pop('_id', None)
+            if all(v in (False, 0) for v in projection.values()):
+                sort_key_path = sort_key.split('.')
+                for i in range(1, len(sort_key_path) + 1):
+                    projection.pop('.'.join(sort_key_path[:i]), None)
+                projection = projection or None
+            else:
+                projection[sort_key] = True
+
+        cursor = self.col.find(query, projection).sort([(sort_key, direction), ('_id', direction)]).limit(page_size + 1)
+        res_data = list(cursor)
+        next_after = None
+        if len(res_data) > page_size:
+            res_data = res_data[:page_size]
+            next_after = (get_value_by_path(res_data[-1], sort_key), res_data[-1]['_id'])
+        for data in res_data:
+            del data['_id']
+        return res_data, next_after
+
+    def get_many_by_name(self, name, projection=None):
+        res = self.col.find({"name": name}, self.build_projection(projection, True))
         return list(res)
 
-    def get_many_by_filter(self, filter_dict):
+    def get_many_by_filter(self, filter_dict, projection=None):
         """ filter ex: {'key1': 'value1', 'key2': 'value2', 'key3': 'value4'} """
-        res = self.col.find(filter_dict, {'_id': False})
+        res = self.col.find(filter_dict, self.build_projection(projection))
         return list(res)
 
-    def get_one_by_name(self, name):
-        res = self.col.find_one({"name": name}, {'_id': False})
+    def get_one_by_name(self, name, projection=None):
+        res = self.col.find_one({"name": name}, self.build_projection(projection))
         return res
 
-    def get_one_by_key(self, key, value):
-        res = self.col.find_one({key: value}, {'_id': False})
+    def get_one_by_key(self, key, value, projection=None):
+        res = self.col.find_one({key: value}, self.build_projection(projection))
         return res
 
-    def get_one_by_id(self, _id):
-        res = self.col.find_one({"_id": _id})
+    def get_one_by_id(self, _id, projection=None):
+        res = self.col.find_one({"_id": _id}, self.build_projection(projection, True))
         return res
 
-    def get_one_by_filter(self, filter_dict):
+    def get_one_by_filter(self, filter_dict, projection=None):
         """ filter ex: {'key1': 'value1', 'key2': 'value2', 'key3': 'value4'} """
-        res = self.col.find_one(filter_dict, {'_id': False})
+        res = self.col.find_one(filter_dict, self.build_projection(projection))
         return res
 
     def get_collection_name_in_db(self):
         collections = self.db.list_collection_names()
         return collections
 
+    def ensure_indexes(self, index_models):
+        """ Create indexes if not exist, index_models ex: [IndexModel([('name', ASCENDING)])] """
+        try:
+            res = self.col.create_indexes(index_models)
+        except OperationFailure as exc:
+            # Index with same name or keys but different options exists, keep the existing one
+            LOGGER.error(f"Create index error, collection: {self.db_col}, detail: {exc}")
+            return []
+        return res
+
+    def explain_stages(self, filter_dict, sort=None):
+        """ Get the stage names of winning plan, ex: ['FETCH', 'IXSCAN'] or ['COLLSCAN'] """
+        cursor = self.col.find(filter_dict)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        stages = []
+        plan_list = [plan]
+        while plan_list:
+            # Slot based engine (mongo 5.1+) wraps the plan in {'queryPlan': {...}, 'slotBasedPlan': {...}}
+            plan = plan_list.pop()
+            plan = plan.get('queryPlan', plan)
+            if 'stage' in plan:
+                stages.append(plan['stage'])
+            if 'inputStage' in plan:
+                plan_list.append(plan['inputStage'])
+            plan_list.extend(plan.get('inputStages', []))
+            # Plan of each shard when explain on mongos
+            plan_list.extend(shard['winningPlan'] for shard in plan.get('shards', []) if 'winningPlan' in shard)
+        return stages
+
+    def get_cluster_time(self):
+        """ Cluster time of last operation, None on standalone server """
+        return self.db.command('ping').get('operationTime')
+
+    def watch(self, pipeline=None, resume_after=None, max_await_time_ms=1000):
+        """
+        Change stream of collection, update event has the full document. Replica set only
+        pipeline ex: [{'$project': {'fullDocument.device_config': False}}]
+        """
+        return self.col.watch(pipeline, full_document='updateLookup', resume_after=resume_after,
+                              max_await_time_ms=max_await_time_ms)
+
+    @write_method
     def write_one(self, data):
         self.col.insert(data)
 
+    @write_method
+    def write_many(self, data_list, ordered=True):
+        """ Insert list of data in one request, return inserted count """
+        if not data_list:
+            return 0
+        try:
+            res = self.col.insert_many(data_list, ordered=ordered)
+        except BulkWriteError as exc:
+            LOGGER.error(f"Write many data error, collection: {self.db_col}, detail: {exc.details['writeErrors']}")
+            return exc.details['nInserted']
+        return len(res.inserted_ids)
+
+    @write_method
+    def bulk_write(self, requests, ordered=False):
+        """
+        Execute mixed write requests in one request
+        requests ex: [InsertOne({...}), UpdateOne({'name': 'A'}, {'$set': {...}}, upsert=True), DeleteOne({'name': 'B'})]
+        Output:
+        {
+          "inserted": 1, "matched": 1, "modified": 1, "upserted": 0, "deleted": 1,
+          "errors": [{"index": 2, "code": 11000, "errmsg": "xxx"}]  # index of input requests
+        }
+        """
+        res_data = {'inserted': 0, 'matched': 0, 'modified': 0, 'upserted': 0, 'deleted': 0, 'errors': []}
+        if not requests:
+            return res_data
+        try:
+            res = self.col.bulk_write(requests, ordered=ordered)
+            details = res.bulk_api_result
+        except BulkWriteError as exc:
+            details = exc.details
+            LOGGER.error(f"Bulk write error, collection: {self.db_col}, error count: {len(details['writeErrors'])}")
+        res_data['inserted'] = details['nInserted']
+        res_data['matched'] = details['nMatched']
+        res_data['modified'] = details['nModified']
+        res_data['upserted'] = details['nUpserted']
+        res_data['deleted'] = details['nRemoved']
+        res_data['errors'] = [{'index': e['index'], 'code': e['code'], 'errmsg': e['errmsg']}
+                              for e in details.get('writeErrors', [])]
+        return res_data
+
+    def bulk_upsert(self, filter_data_list, ordered=False):
+        """
+        Upsert many data in one request
+        filter_data_list ex: [({'name': 'A'}, {'name': 'A', 'up': True}), ({'name': 'B'}, {'name': 'B', 'up': False})]
+        """
+        requests = [UpdateOne(filter, {"$set": data}, upsert=True) for filter, data in filter_data_list]
+        return self.bulk_write(requests, ordered=ordered)
+
+    @write_method
     def update_one(self, filter, data):
-        """ filter ex: {'key1': 'value1', 'key2': 'value2', 'key3': 'value4'} """
-        self.col.update_one(filter, data)
+        """ filter ex: {'key1': 'value1', 'key2': 'value2', 'key3': 'value4'}, return matched count """
+        res = self.col.update_one(filter, data)
+        return res.matched_count
 
+    @write_method
+    def upsert_one(self, filter, data):
+        """ Set data on matching document or insert a new one, return True when inserted """
+        res = self.col.update_one(filter, {"$set": data}, upsert=True)
+        return res.upserted_id is not None
+
+    @write_method
+    def find_one_and_update(self, filter, data, upsert=False, return_new=True, projection=None):
+        """ Atomic update and return the document before/after update, None if not found """
+        return_document = ReturnDocument.AFTER if return_new else ReturnDocument.BEFORE
+        res = self.col.find_one_and_update(filter, data, projection=projection, upsert=upsert,
+                                           return_document=return_document)
+        return res
+
+    @write_method
     def update_many(self, filter, data):
         """ filter ex: {'key1': 'value1', 'key2': 'value2', 'key3': 'value4'} """
         self.col.update_many(filter, data)
 
     def check_exist_one_by_name(self, name):
-        data = self.col.find_one({"name": name})
+        data = self.col.find_one({"name": name}, {"_id": True})
         if data:
             return True
         return False
 
     def check_exist_one(self, filter_data):
-        data = self.col.find_one(filter_data)
+        data = self.col.find_one(filter_data, {"_id": True})
         if data:
             return True
         return False
 
     def check_exist_one_by_id(self, _id):
-        data = self.col.find_one({"_id": ObjectId(_id)})
+        data = self.col.find_one({"_id": ObjectId(_id)}, {"_id": True})
         if data:
             return True
         return False
 
+    @write_method
     def delete_one_by_name(self, name):
         self.col.delete_one({"name": name})
 
+    @write_method
     def delete_one_by_key(self, key, value):
         self.col.delete_one({key: value})
 
+    @write_method
     def delete_one_by_filter(self, filter):
         """ Delete all matching cursor, input dict sample: {"name": "A", "type": "application"} """
         self.col.delete_one(filter)
 
+    @write_method
     def delete_one_by_id(self, _id):
         try:
             self.col.delete_one({"_id": ObjectId(_id)})
@@ -113,9 +471,63 @@ class DataLoader():
             return False
         return True
 
+    @write_method
     def delete_many_by_filter(self, filter):
         """ Delete all matching cursor, input dict sample: {"name": "A", "type": "application"} """
         self.col.delete_many(filter)
 
+    @write_method
+    def delete_many_by_name(self, name_list):
+        """ Delete all data which name in name_list """
+        self.col.delete_many({"name": {"$in": name_list}})
+
+    @write_method
     def delete_collection(self):
         self.col.drop()
+
+
+class AsyncDataLoader():
+    """
+    Async version of DataLoader, every DataLoader method is awaitable and run in a shared executor
+    ex: data = await AsyncDataLoader(ip, port, db, col).get_one_by_name('A')
+    """
+    def __init__(self, mongodb_ip, mongodb_port, mongodb_db, mongodb_col="", **client_options):
+        self.loader = DataLoader(mongodb_ip, mongodb_port, mongodb_db, mongodb_col, **client_options)
+
+    def __getattr__(self, attr):
+        func = getattr(self.loader, attr)
+        if not callable(func):
+            return func
+        if attr.startswith('iter_'):
+            return self._async_iter(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(_get_async_executor(), functools.partial(func, *args, **kwargs))
+        return wrapper
+
+    @staticmethod
+    def _async_iter(func):
+        """ Wrap generator method as async generator, fetch one batch in executor each time """
+        signature = inspect.signature(func)
+        batch_size_param = signature.parameters.get('batch_size')
+        default_batch_size = batch_size_param.default if batch_size_param is not None else ITER_BATCH_SIZE
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            # Same arguments as DataLoader method, batch_size may be positional
+            batch_size = signature.bind_partial(*args, **kwargs).arguments.get('batch_size', default_batch_size)
+            loop = asyncio.get_running_loop()
+            executor = _get_async_executor()
+            gen = func(*args, **kwargs)
+            try:
+                while True:
+                    batch = await loop.run_in_executor(executor, list, itertools.islice(gen, batch_size))
+                    if not batch:
+                        break
+                    for data in batch:
+                        yield data
+            finally:
+                await loop.run_in_executor(executor, gen.close)
+        return wrapper
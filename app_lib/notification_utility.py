@@ -0,0 +1,208 @@
+import time
+import uuid
+import queue
+import atexit
+import logging
+import threading
+
+from dynaconf import settings
+from fastapi import HTTPException
+
+from app_lib.rest_utility import send_restful
+
+# Setting Logger
+LOGGER = logging.getLogger(__name__)
+
+# Default setting, override by settings NOTIFICATION_DISPATCHER
+DISPATCHER_SETTING = {
+    'QUEUE_SIZE': 10000,     # Drop new notification when queue is full
+    'WORKERS': 2,
+    'BATCH_SIZE': 50,        # Max notifications a worker takes from queue at a time
+    'LINGER': 0.5,           # Seconds to wait for more notifications after the first one
+    'MAX_RETRY': 3,
+    'BACKOFF': 1.0,          # Retry after BACKOFF, 2*BACKOFF, 4*BACKOFF... seconds
+    'TIMEOUT': 8,
+}
+
+DISPATCHER = None
+
+
+class NotificationDispatcher():
+    """
+    Send notifications to notificationmgr in background workers, caller never waits on network
+    notificationmgr has no batch api, every notification is still posted by itself,
+    a batch only bounds how many a worker takes from the queue at a time.
+    """
+    def __init__(self, **kwargs):
+        self.setting = dict(DISPATCHER_SETTING, **kwargs)
+        self.queue = queue.Queue(maxsize=self.setting['QUEUE_SIZE'])
+        self.counters = {'queued': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'dropped': 0, 'batches': 0}
+        self._counter_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._workers = []
+
+    def _count(self, key, value=1):
+        with self._counter_lock:
+            self.counters[key] += value
+
+    def start(self):
+        LOGGER.warning(f"Start notification dispatcher, setting: {self.setting}")
+        self._stop.clear()
+        for i in range(self.setting['WORKERS']):
+            worker = threading.Thread(target=self._run, name=f"notification-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, timeout=5):
+        """ Stop workers after queue is drained or timeout """
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._stop.set()
+        for worker in self._workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+        self._workers = []
+
+    def submit(self, req_url: str, payload: dict) -> bool:
+        """ Put notification in queue, return False when queue is full and notification is dropped """
+        try:
+            self.queue.put_nowait((req_url, payload))
+        except queue.Full:
+            self._count('dropped')
+            LOGGER.error(f"Notification queue is full, drop notification, req_url: {req_url}, payload: {payload}")
+            return False
+        self._count('queued')
+        return True
+
+    def _next_batch(self):
+        """ Wait for first notification, then collect more until BATCH_SIZE or LINGER """
+        try:
+            batch = [self.queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.setting['LINGER']
+        while len(batch) < self.setting['BATCH_SIZE']:
+            remain = deadline - time.monotonic()
+            if remain <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remain))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            self._count('batches')
+            try:
+                self._send_batch(batch)
+            except Exception as exc:
+                LOGGER.error(f"Send notification batch error, detail: {exc!r}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _send_batch(self, batch: list):
+        for req_url, payload in batch:
+            self._send_with_retry(req_url, payload)
+
+    def _send_with_retry(self, req_url: str, payload: dict):
+        for retry in range(self.setting['MAX_RETRY'] + 1):
+            if retry:
+                self._count('retried')
+                # Wake up early when stopping, remaining retries are still tried once
+                self._stop.wait(self.setting['BACKOFF'] * 2 ** (retry - 1))
+            try:
+                _, res_code = send_restful(req_url, req_type='post', payload=payload, time_out=self.setting['TIMEOUT'])
+            except HTTPException:
+                res_code = 0
+            except Exception as exc:
+                # ex: requests.exceptions.InvalidURL, ChunkedEncodingError, worker must keep running
+                LOGGER.error(f"Send api to notification error, req_url: {req_url}, detail: {exc!r}")
+                res_code = 0
+            if res_code == 201:
+                self._count('sent')
+                return True
+            if 400 <= res_code < 500:
+                # Client error will not be fixed by retry
+                break
+        LOGGER.error(f"Send api to notification error, req_url: {req_url}, res_code: {res_code}")
+        self._count('failed')
+        return False
+
+    def stats(self):
+        with self._counter_lock:
+            res_data = dict(self.counters)
+        res_data['queue_depth'] = self.queue.qsize()
+        res_data['queue_size'] = self.setting['QUEUE_SIZE']
+        return res_data
+
+
+def start_notification_dispatcher():
+    """ Start dispatcher when settings NOTIFICATION_DISPATCHER is set, otherwise notifications are sent inline """
+    global DISPATCHER
+    dispatcher_setting = settings.get('NOTIFICATION_DISPATCHER', {})
+    if not dispatcher_setting or DISPATCHER is not None:
+        return
+    DISPATCHER = NotificationDispatcher(**dispatcher_setting)
+    DISPATCHER.start()
+    atexit.register(DISPATCHER.stop)
+
+
+def dispatch_notification(req_url: str, payload: dict) -> bool:
+    """ Return False when dispatcher is not running, caller should send it by itself """
+    if DISPATCHER is None:
+        return False
+    DISPATCHER.submit(req_url, payload)
+    return True
+
+
+def get_notification_stats():
+    """ Output: {"queue_depth": 0, "queue_size": 10000, "queued": 10, "sent": 10, ...}, {} when disabled """
+    return DISPATCHER.stats() if DISPATCHER else {}
+
+
+def send_mgmt_notification(level: str, subject: str, api_url: str, detail_msg: str, body: dict = {}):
+    """ When System error, send notification api to notifactionmgr, queued when dispatcher is running """
+    req_url = f"http://{settings['NOTIFICATIONMGR_SERVER']['IP']}:{settings['NOTIFICATIONMGR_SERVER']['PORT']}/hermesnotification/mgmt"
+    send_data = {}
+    send_data['name'] = 'devicemgr'
+    send_data['level'] = level
+    send_data['subject'] = subject
+    send_data['req_url'] = str(api_url)
+    send_data['detail_msg'] = detail_msg
+    if body:
+        send_data['body'] = body
+    if dispatch_notification(req_url, send_data):
+        return
+    _, res_code = send_restful(req_url, req_type='post', payload=send_data, time_out=8)
+    if res_code != 201:
+        LOGGER.error(f"Send api to notification error, req_url: {req_url}")
+    return
+
+
+def send_device_notification(device_name: str, subject: str, level: str, detail_msg: str, timestamp: int):
+    """
+    When device event, send notification api to notificationmgr, queued when dispatcher is running
+    level: Info/Warning/Critical
+    """
+    req_url = f"http://{settings['NOTIFICATIONMGR_SERVER']['IP']}:{settings['NOTIFICATIONMGR_SERVER']['PORT']}/hermesnotification/agent"
+    send_data = {}
+    sub_data = {}
+    send_data['name'] = device_name
+    sub_data['uuid'] = str(uuid.uuid1())
+    sub_data['subject'] = subject
+    sub_data['read'] = False
+    sub_data['level'] = level
+    sub_data['message'] = detail_msg
+    sub_data['timestamp'] = timestamp
+    send_data['notification'] = sub_data
+    if dispatch_notification(req_url, send_data):
+        return
+    _, res_code = send_restful(req_url, req_type='post', payload=send_data, time_out=8)
+    if res_code != 201:
+        LOGGER.error(f"Send api to notification error, req_url: {req_url}")
+    return
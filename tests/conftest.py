@@ -0,0 +1,27 @@
+import os
+import sys
+
+import mongomock
+import pytest
+
+from dynaconf import settings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app_lib import mongo_utility  # noqa: E402
+
+
+@pytest.fixture
+def mongo_client(monkeypatch):
+    """ Every DataLoader shares one in-memory mongomock client """
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(mongo_utility, 'get_mongo_client', lambda *args, **kwargs: client)
+    return client
+
+
+@pytest.fixture
+def device_settings(mongo_client):
+    settings.set('MONGO_SERVER', {'IP': '127.0.0.1', 'PORT': 27017})
+    settings.set('MONGO', {'DEVICE': {'DB': 'device', 'FULLINFO': {'COL': 'fullinfo'}, 'MONITOR': {'COL': 'monitor'},
+                                      'LEASE': {'COL': 'lease'}}})
+    return mongo_client
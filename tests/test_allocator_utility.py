@@ -0,0 +1,45 @@
+from app_lib.allocator_utility import IdAllocator
+from app_lib.mongo_utility import DataLoader
+
+
+def get_allocator(low=1, high=4):
+    allocator = IdAllocator(DataLoader('127.0.0.1', 27017, 'device', 'allocator'), 'test_id', low, high)
+    allocator.setup()
+    return allocator
+
+
+def test_allocate_until_exhausted(mongo_client):
+    allocator = get_allocator()
+    assert [allocator.allocate() for _ in range(4)] == [1, 2, 3, 4]
+    assert allocator.allocate() is None
+
+
+def test_release_and_reuse(mongo_client):
+    allocator = get_allocator()
+    for _ in range(4):
+        allocator.allocate()
+    assert allocator.release(2)
+    assert not allocator.release(2)
+    assert not allocator.release(9)
+    assert allocator.allocate() == 2
+    assert allocator.snapshot() == {'next': 5, 'free': []}
+
+
+def test_setup_with_used_ids(mongo_client):
+    allocator = IdAllocator(DataLoader('127.0.0.1', 27017, 'device', 'allocator'), 'test_id', 1, 10)
+    allocator.setup([1, 3, 4])
+    assert allocator.snapshot() == {'next': 5, 'free': [2]}
+    # Setup again keeps the existing document
+    allocator.setup()
+    assert allocator.snapshot() == {'next': 5, 'free': [2]}
+
+
+def test_workers_share_allocator_state(mongo_client):
+    # Allocators in different workers only share the document, ids never collide
+    allocator_a = get_allocator(1, 6)
+    allocator_b = get_allocator(1, 6)
+    id_list = [allocator.allocate() for allocator in (allocator_a, allocator_b) * 3]
+    assert sorted(id_list) == [1, 2, 3, 4, 5, 6]
+    assert allocator_b.release(id_list[0])
+    assert allocator_a.allocate() == id_list[0]
+    assert allocator_b.allocate() is None
@@ -0,0 +1,24 @@
+import pytest
+from fastapi import HTTPException
+
+from app_lib.basic_func import update_db_data, write_data_to_mongo
+from app_lib.mongo_utility import DataLoader
+
+
+def test_write_data_without_filter_key(device_settings):
+    write_data_to_mongo('device', 'staging', {'name': 'a'}, {'config': 1}, 'staging')
+    assert device_settings['device']['staging'].find_one({}, {'_id': False}) == {'name': 'a', 'config': 1}
+    write_data_to_mongo('device', 'staging', {'name': 'a'}, {'config': 2}, 'staging')
+    assert device_settings['device']['staging'].find_one({}, {'_id': False}) == {'name': 'a', 'config': 2}
+
+
+def test_update_db_data_errors(device_settings):
+    db = DataLoader('127.0.0.1', 27017, 'device', 'staging')
+    with pytest.raises(HTTPException) as exc_info:
+        update_db_data(db, {'name': 'a'}, {'config': 1}, 'staging')
+    assert exc_info.value.status_code == 400
+    db.write_one({'name': 'a', 'config': 1})
+    with pytest.raises(HTTPException) as exc_info:
+        update_db_data(db, {'name': 'a'}, {'name': 'b', 'config': 2}, 'staging')
+    assert exc_info.value.status_code == 400
+    assert update_db_data(db, {'name': 'a'}, {'config': 2}, 'staging') == {'config': 2}
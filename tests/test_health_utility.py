@@ -0,0 +1,146 @@
+import time
+
+import pytest
+
+from app_lib import health_utility, job_func_utility
+from app_lib.health_utility import HealthScheduler
+from app_lib.job_func_utility import checking_device_procedure
+
+
+@pytest.fixture
+def notifications(device_settings, monkeypatch):
+    sent = []
+    monkeypatch.setattr(job_func_utility, 'send_device_notification', lambda name, subject, *args: sent.append(subject))
+    return sent
+
+
+def wait_for(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_sweep_notifies_transitions_once(device_settings, notifications):
+    now = time.time()
+    device_settings['device']['fullinfo'].insert_many([{'name': 'a', 'timestamp': now},
+                                                       {'name': 'b', 'timestamp': now - 200},
+                                                       {'name': 'c', 'timestamp': now}])
+    device_settings['device']['monitor'].insert_many([{'name': 'a', 'up': False}, {'name': 'b', 'up': True}])
+    summary = checking_device_procedure()
+    assert (summary['up'], summary['down'], summary['new']) == (1, 1, 1)
+    assert sorted(notifications) == ['Device a up', 'Device b down', 'Device c up']
+    assert checking_device_procedure()['unchanged'] == 3
+    assert len(notifications) == 3
+
+
+def test_sweep_commits_with_one_bulk_write(device_settings, notifications, monkeypatch):
+    now = time.time()
+    device_settings['device']['fullinfo'].insert_many([{'name': f"device_{i}", 'timestamp': now - 200} for i in range(50)])
+    device_settings['device']['monitor'].insert_many([{'name': f"device_{i}", 'up': True} for i in range(50)])
+    bulk_write = job_func_utility.DataLoader.bulk_write
+    bulk_calls = []
+
+    def count_bulk_write(db, requests, ordered=False):
+        bulk_calls.append(len(requests))
+        return bulk_write(db, requests, ordered)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('write of single device in sweep')
+
+    monkeypatch.setattr(job_func_utility.DataLoader, 'bulk_write', count_bulk_write)
+    monkeypatch.setattr(job_func_utility.DataLoader, 'update_one', fail)
+    monkeypatch.setattr(job_func_utility.DataLoader, 'find_one_and_update', fail)
+    assert checking_device_procedure()['down'] == 50
+    assert bulk_calls == [50]
+    assert len(notifications) == 50
+
+
+def test_sweep_skips_transition_committed_by_scheduler(device_settings, notifications, monkeypatch):
+    device_settings['device']['fullinfo'].insert_one({'name': 'a', 'timestamp': time.time() - 200})
+    device_settings['device']['monitor'].insert_one({'name': 'a', 'up': True})
+    load_up_flags = job_func_utility.FleetState.load_up_flags
+
+    def load_then_commit(fleet, records):
+        load_up_flags(fleet, records)
+        # Scheduler commits the same transition after sweep loaded monitor state
+        job_func_utility.commit_device_transition(job_func_utility.get_device_db('MONITOR'), 'a', False, time.time())
+
+    monkeypatch.setattr(job_func_utility.FleetState, 'load_up_flags', load_then_commit)
+    summary = checking_device_procedure()
+    assert summary['skipped'] == 1
+    assert notifications == ['Device a down']
+
+
+def test_report_does_no_io(device_settings, notifications, monkeypatch):
+    scheduler = HealthScheduler()
+    scheduler._deadline['a'] = time.time() - 200
+    scheduler._up['a'] = False
+
+    def fail(*args):
+        raise AssertionError('db access on report path')
+
+    monkeypatch.setattr(health_utility, 'get_device_db', fail)
+    scheduler.report('a', time.time())
+    assert scheduler._pending_up == ['a']
+    assert notifications == []
+
+
+def test_scheduler_fires_up_and_down(device_settings, notifications, monkeypatch):
+    monkeypatch.setattr(health_utility, 'DEVICE_HEALTH_TIMEOUT', 0.3)
+    monkeypatch.setattr(job_func_utility, 'DEVICE_HEALTH_TIMEOUT', 0.3)
+    fullinfo = device_settings['device']['fullinfo']
+    fullinfo.insert_one({'name': 'a', 'timestamp': time.time() - 200})
+    device_settings['device']['monitor'].insert_one({'name': 'a', 'up': False})
+    scheduler = HealthScheduler(reconcile_interval=100)
+    scheduler.start()
+    try:
+        assert wait_for(lambda: scheduler._up.get('a') is False)
+        timestamp = time.time()
+        fullinfo.update_one({'name': 'a'}, {'$set': {'timestamp': timestamp}})
+        scheduler.report('a', timestamp)
+        assert wait_for(lambda: notifications == ['Device a up'])
+        # No more report, deadline passes
+        assert wait_for(lambda: notifications == ['Device a up', 'Device a down'])
+    finally:
+        scheduler.stop()
+    assert device_settings['device']['monitor'].find_one({'name': 'a'})['up'] is False
+
+
+def test_sweep_skips_devices_of_lost_shard(device_settings, notifications, monkeypatch):
+    device_settings['device']['fullinfo'].insert_one({'name': 'a', 'timestamp': time.time()})
+    lease = job_func_utility.ShardLease(job_func_utility.get_device_db('LEASE'), 'health', 1)
+    lease.refresh()
+    # Shard is taken over while sweeping
+    monkeypatch.setattr(lease, 'renew', lambda: set())
+    summary = checking_device_procedure(lease.shards, 1, lease)
+    assert notifications == []
+    assert summary['new'] == 0
+
+
+def test_partitioned_sweep_reads_only_its_shards(device_settings, notifications, monkeypatch):
+    monkeypatch.setattr(job_func_utility, 'HEALTH_SHARDS', 2)
+    now = time.time()
+    fullinfo = device_settings['device']['fullinfo']
+    fullinfo.insert_many([dict({'name': f"device_{i}", 'timestamp': now},
+                               **job_func_utility.gen_health_shard_fields(f"device_{i}")) for i in range(20)])
+    # Saved before shard fields or with another shard count
+    fullinfo.insert_many([{'name': 'legacy_a', 'timestamp': now}, {'name': 'legacy_b', 'timestamp': now,
+                                                                    'health_shards': 4, 'health_shard': 0}])
+    shard_count = job_func_utility.get_health_shard_count()
+    name_list = [d['name'] for d in fullinfo.find() if job_func_utility.get_shard(d['name'], shard_count) == 0]
+    read_names = []
+    iter_many_by_filter = job_func_utility.DataLoader.iter_many_by_filter
+
+    def record_iter(db, filter_dict, projection=None, *args, **kwargs):
+        for data in iter_many_by_filter(db, filter_dict, projection, *args, **kwargs):
+            if db.db_col == 'fullinfo':
+                read_names.append(data['name'])
+            yield data
+
+    monkeypatch.setattr(job_func_utility.DataLoader, 'iter_many_by_filter', record_iter)
+    summary = checking_device_procedure({0}, shard_count)
+    assert summary['new'] == len(name_list)
+    assert sorted(notifications) == sorted(f"Device {name} up" for name in name_list)
+    # Only devices of shard 0 and devices without valid shard fields are read
+    assert sorted(read_names) == sorted(set(name_list) | {'legacy_a', 'legacy_b'})
@@ -0,0 +1,29 @@
+import asyncio
+import functools
+
+import httpx
+from dynaconf import settings
+
+from app_lib import igate_utility
+
+
+def handler(request):
+    if request.url.host == '10.0.0.1':
+        return httpx.Response(200, json=['device_a'])
+    raise httpx.ConnectError('connection refused', request=request)
+
+
+def test_sweep_treats_broken_entries_as_offline(mongo_client, monkeypatch):
+    settings.set('MONGO_SERVER', {'IP': '127.0.0.1', 'PORT': 27017})
+    settings.set('MONGO', {'GWPOOL': {'DB': 'gw', 'COL': 'gwpool'}})
+    monkeypatch.setattr(igate_utility.httpx, 'AsyncClient',
+                        functools.partial(httpx.AsyncClient, transport=httpx.MockTransport(handler)))
+    gwpool = mongo_client['gw']['gwpool']
+    gwpool.insert_many([{'name': 'up', 'ip': '10.0.0.1', 'port': '80', 'status': False},
+                        {'name': 'down', 'ip': '10.0.0.2', 'port': '80', 'status': True},
+                        {'name': 'bad_url', 'ip': 'bad host', 'port': 'x', 'status': True},
+                        {'name': 'no_ip', 'status': True}])
+    res_data = asyncio.run(igate_utility.sweep_igate_status())
+    assert res_data['up']['status'] and res_data['up']['device_list'] == ['device_a']
+    assert [res_data[name]['status'] for name in ('down', 'bad_url', 'no_ip')] == [False, False, False]
+    assert {gw['name']: gw['status'] for gw in gwpool.find()} == {'up': True, 'down': False, 'bad_url': False, 'no_ip': False}
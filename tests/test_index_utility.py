@@ -0,0 +1,16 @@
+from pymongo.errors import OperationFailure
+
+from app_lib import index_utility
+from app_lib.mongo_utility import DataLoader
+
+
+def test_report_collection_scans_skips_failed_explain(device_settings, monkeypatch):
+    def explain_stages(db, filter_dict, sort=None):
+        if db.db_col == 'fullinfo':
+            raise OperationFailure('not authorized on device to execute command explain')
+        return ['COLLSCAN']
+
+    monkeypatch.setattr(DataLoader, 'explain_stages', explain_stages)
+    res_data = index_utility.report_collection_scans()
+    # Collections not in settings and the failed explain are skipped
+    assert [(data['col'], data['filter']) for data in res_data] == [('monitor', {'name': ''})]
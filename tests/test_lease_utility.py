@@ -0,0 +1,60 @@
+import datetime
+
+from app_lib.lease_utility import ShardLease, get_shard
+from app_lib.mongo_utility import DataLoader
+
+
+def get_lease_db():
+    return DataLoader('127.0.0.1', 27017, 'device', 'lease')
+
+
+def test_get_shard_is_stable():
+    assert get_shard('device_a', 16) == get_shard('device_a', 16)
+    assert {get_shard(f"device_{i}", 4) for i in range(100)} == {0, 1, 2, 3}
+
+
+def test_unique_index_is_created(mongo_client):
+    ShardLease(get_lease_db(), 'health', 8)
+    index_info = mongo_client['device']['lease'].index_information()
+    assert any(info.get('unique') and info['key'] == [('name', 1)] for info in index_info.values())
+
+
+def test_two_workers_split_shards(mongo_client):
+    lease_a = ShardLease(get_lease_db(), 'health', 8)
+    lease_b = ShardLease(get_lease_db(), 'health', 8)
+    assert lease_a.refresh() == set(range(8))
+    assert lease_b.refresh() == set()
+    # Worker a sees two members and releases extra shards, b takes them
+    lease_a.refresh()
+    lease_b.refresh()
+    assert len(lease_a.shards) == 4
+    assert len(lease_b.shards) == 4
+    assert lease_a.shards.isdisjoint(lease_b.shards)
+
+
+def test_claim_held_lease_fails_until_expired(mongo_client):
+    lease_a = ShardLease(get_lease_db(), 'health', 1, ttl=60)
+    lease_b = ShardLease(get_lease_db(), 'health', 1, ttl=60)
+    now = datetime.datetime.utcnow()
+    assert lease_a.claim(0, now)
+    assert not lease_b.claim(0, now)
+    assert lease_b.claim(0, now + datetime.timedelta(seconds=61))
+
+
+def test_renew_drops_lost_shard(mongo_client):
+    lease_a = ShardLease(get_lease_db(), 'health', 2, ttl=60)
+    lease_b = ShardLease(get_lease_db(), 'health', 2, ttl=60)
+    lease_a.refresh()
+    assert lease_a.shards == {0, 1}
+    # Lease a paused longer than ttl, b takes over shard 0
+    later = datetime.datetime.utcnow() + datetime.timedelta(seconds=61)
+    assert lease_b.claim(0, later)
+    assert lease_a.renew(later) == {1}
+
+
+def test_release_all_hands_over_shards(mongo_client):
+    lease_a = ShardLease(get_lease_db(), 'health', 4)
+    lease_b = ShardLease(get_lease_db(), 'health', 4)
+    lease_a.refresh()
+    lease_a.release_all()
+    assert lease_b.refresh() == {0, 1, 2, 3}
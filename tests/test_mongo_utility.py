@@ -0,0 +1,77 @@
+import asyncio
+
+import mongomock
+
+from dynaconf.vendor.box import BoxList
+
+from app_lib import mongo_utility
+
+
+def test_client_pool_key_accepts_list_options(monkeypatch):
+    monkeypatch.setattr(mongo_utility, 'MongoClient', lambda *args, **kwargs: object())
+    monkeypatch.setattr(mongo_utility, '_CLIENT_POOL', {})
+    listener = object()
+    client = mongo_utility.get_mongo_client('127.0.0.1', 27017, compressors=BoxList(['zstd']),
+                                            event_listeners=[listener])
+    assert mongo_utility.get_mongo_client('127.0.0.1', 27017, compressors=['zstd'],
+                                          event_listeners=[listener]) is client
+    assert mongo_utility.get_mongo_client('127.0.0.1', 27017, compressors=['zlib'],
+                                          event_listeners=[listener]) is not client
+
+
+def test_get_page_keeps_sort_key_in_projection(mongo_client):
+    db = mongo_utility.DataLoader('127.0.0.1', 27017, 'device', 'page')
+    db.write_many([{'name': f"device_{i}", 'seq': i, 'detail': {'seq': i}} for i in range(5)])
+    for projection in (['name'], {'seq': False}, {'_id': False, 'detail': False}, {'detail': 0, 'seq': 0}):
+        after, seq_list = None, []
+        while True:
+            res_data, after = db.get_page('seq', 2, after, projection=projection)
+            seq_list.extend(data['seq'] for data in res_data)
+            if after is None:
+                break
+        assert seq_list == [0, 1, 2, 3, 4]
+
+
+def get_all_pages(db, sort_key, reverse=False, page_size=2):
+    after, res_list = None, []
+    while True:
+        res_data, after = db.get_page(sort_key, page_size, after, reverse, projection=['name'])
+        res_list.extend(data['name'] for data in res_data)
+        if after is None:
+            return res_list
+
+
+def test_get_page_by_dotted_sort_key(mongo_client):
+    db = mongo_utility.DataLoader('127.0.0.1', 27017, 'device', 'page')
+    db.write_many([{'name': f"device_{i}", 'detail': {'seq': 4 - i}} for i in range(5)])
+    assert get_all_pages(db, 'detail.seq') == [f"device_{i}" for i in range(4, -1, -1)]
+
+
+def test_get_page_with_null_sort_value(mongo_client):
+    db = mongo_utility.DataLoader('127.0.0.1', 27017, 'device', 'page')
+    db.write_many([{'name': 'a', 'organization': 'org_b'}, {'name': 'b', 'organization': None}, {'name': 'c'},
+                   {'name': 'd', 'organization': 'org_a'}, {'name': 'e', 'organization': None}])
+    for page_size in (1, 2, 3):
+        assert get_all_pages(db, 'organization', page_size=page_size) == ['b', 'c', 'e', 'd', 'a']
+        assert get_all_pages(db, 'organization', True, page_size) == ['a', 'd', 'e', 'c', 'b']
+
+
+def test_async_iter_accepts_positional_batch_size(mongo_client):
+    mongo_client['device']['page'].insert_many([{'name': f"device_{i}"} for i in range(5)])
+    db = mongo_utility.AsyncDataLoader('127.0.0.1', 27017, 'device', 'page')
+
+    async def collect(*args, **kwargs):
+        return [data['name'] async for data in db.iter_all_elements(*args, **kwargs)]
+
+    name_list = [f"device_{i}" for i in range(5)]
+    assert asyncio.run(collect(['name'], 2)) == name_list
+    assert asyncio.run(collect(['name'], batch_size=2)) == name_list
+    assert asyncio.run(collect(['name'])) == name_list
+
+
+def test_explain_stages_of_slot_based_plan(mongo_client, monkeypatch):
+    db = mongo_utility.DataLoader('127.0.0.1', 27017, 'device', 'page')
+    winning_plan = {'queryPlan': {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}, 'slotBasedPlan': {'slots': ''}}
+    monkeypatch.setattr(mongomock.collection.Cursor, 'explain', lambda cursor: {'queryPlanner': {'winningPlan': winning_plan}},
+                        raising=False)
+    assert db.explain_stages({'name': ''}) == ['FETCH', 'IXSCAN']
@@ -0,0 +1,35 @@
+import time
+
+from app_lib import notification_utility
+from app_lib.notification_utility import NotificationDispatcher
+
+
+def test_worker_survives_unexpected_error(monkeypatch):
+    sent = []
+
+    def send_restful(req_url, **kwargs):
+        if kwargs['payload']['i'] == 0:
+            raise ValueError('Invalid URL')
+        sent.append(kwargs['payload']['i'])
+        return {}, 201
+
+    monkeypatch.setattr(notification_utility, 'send_restful', send_restful)
+    dispatcher = NotificationDispatcher(WORKERS=1, MAX_RETRY=0, LINGER=0)
+    for i in range(3):
+        dispatcher.submit('http://notificationmgr/agent', {'i': i})
+    dispatcher.start()
+    time_start = time.monotonic()
+    dispatcher.stop(timeout=5)
+    assert time.monotonic() - time_start < 2
+    assert sorted(sent) == [1, 2]
+    stats = dispatcher.stats()
+    assert (stats['sent'], stats['failed'], stats['queue_depth']) == (2, 1, 0)
+    # LINGER is 0, every notification is taken from queue in its own batch
+    assert stats['batches'] == 3
+
+
+def test_full_queue_drops_without_blocking():
+    dispatcher = NotificationDispatcher(QUEUE_SIZE=1)
+    assert dispatcher.submit('http://notificationmgr/agent', {'i': 0})
+    assert not dispatcher.submit('http://notificationmgr/agent', {'i': 1})
+    assert dispatcher.stats()['dropped'] == 1